@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Print an animation as a flip-book strip: each frame rendered one after the other, like image2.py.
+
+Most of an animation doesn't change from one frame to the next, so the matching (the slow part) is only
+repeated for the blocks that changed.  Each frame's HOG is compared with the HOG that the printed
+characters were matched to; blocks that moved further than --threshold (the distance between the
+histogram-blocks, as used for matching, as a fraction of the size of the block) are matched again,
+and the rest keep their characters.  The default is enough to ignore the dithering noise in a GIF.
+With --threshold 0, only blocks that changed at all are matched again, and the text is the same
+as rendering every frame separately.
+
+The input is an animated GIF (or anything else imageio can read as frames), or a directory of pictures
+(in filename order).  Each frame is written as soon as it's done.
+    python animate.py --width 32 --output - cat.gif
+"""
+
+import os
+import sys
+import io
+import time
+import numpy as np
+import imageio
+import click
+import matcher
+import image2
+import encode
+import batch
+
+
+def read_frames(filename):
+    """:return: iterator of the frames (decoded images) of an animation, or a directory of pictures"""
+    if os.path.isdir(filename):
+        return (imageio.imread(path) for path in batch.find_images([filename]))
+    return iter(imageio.get_reader(filename))
+
+
+class Animation(object):
+    """The characters for each block of the previous frame, and the HOG blocks they were matched to"""
+
+    def __init__(self, chars, threshold=0.0):
+        """
+        :param chars: image2.Matcher
+        :param threshold: how far a block can move before it's matched again,
+                          as a fraction of the size (norm) of the histogram-block it was matched to
+        """
+        self.chars = chars
+        self.threshold = threshold
+        self.reference = None
+        self.strikes = None
+
+    def changed(self, blocks):
+        """:return: boolean mask of the blocks that need matching, (block_rows, block_cols)"""
+        if self.reference is None or self.reference.shape != blocks.shape:
+            return np.ones(blocks.shape[:2], dtype=bool)
+        delta = np.sqrt(((blocks - self.reference) ** 2).sum(axis=(2, 3, 4)))
+        size = np.sqrt((self.reference ** 2).sum(axis=(2, 3, 4)))
+        return delta > self.threshold * size
+
+    def frame(self, fd):
+        """
+        Match the blocks of a frame that have changed.
+        :param fd: the frame's HOG (rows, cols, HOG_ORIENTATIONS)
+        :return: (the text of each layer for each row, the number of blocks that were matched)
+        """
+        blocks = matcher.blocks(fd, image2.BROWS, image2.BCOLS)
+        changed = self.changed(blocks)
+        if self.strikes is None or self.strikes.shape != changed.shape:
+            self.reference = blocks.copy()
+            self.strikes = np.empty(changed.shape, dtype=object)
+
+        # Match all the changed blocks in one go, and remember what they were matched to
+        if changed.any():
+            self.strikes[changed] = self.chars.strikes(blocks[changed])
+            self.reference[changed] = blocks[changed]
+
+        lines = [image2.layer_lines(row, self.chars.layers) for row in self.strikes]
+        return lines, int(changed.sum())
+
+
+@click.command()
+@click.option('--width', default=66, help='Image width (characters)')
+@click.option('--invert', is_flag=True, default=False, help='Invert colors')
+@click.option('--gamma', default=1.0, help='Gamma correction')
+@click.option('--indent', default=0, help='Indent with spaces')
+@click.option('--chars1', help='Characters to use in the first layer')
+@click.option('--chars2', help='Characters to use in the second layer')
+@click.option('--threshold', default=0.1,
+              help='Match a block again when it changes by more than this fraction (0 = exact)')
+@click.option('--output', help='Output filename (use "-" for stdout)')
+@click.option('--baud', default=encode.BAUD, help='Line speed, for the estimated print time')
+@click.argument('filename')
+def main(filename, width, invert, gamma, indent, chars1, chars2, threshold, output, baud):
+    if not output:
+        output = filename + ".txt"
+
+    animation = Animation(image2.Matcher(chars1, chars2), threshold)
+    total = matched = 0
+    with io.open(1 if output == "-" else output, "wb") as f:
+        counter = encode.Counter(f)
+        for (n, frame) in enumerate(read_frames(filename)):
+            started = time.time()
+            fd = image2.process(image2.load_image(frame, width, invert, gamma))
+            (lines, count) = animation.frame(fd)
+            image2.write_rows((encode.encode_row(row, indent) for row in lines), counter)
+
+            blocks = len(lines) * width
+            total += blocks
+            matched += count
+            print("Frame {}: matched {} of {} blocks ({:.0%}) in {:.2f}s".format(
+                n + 1, count, blocks, count / blocks, time.time() - started), file=sys.stderr)
+
+    print("Matched {} of {} blocks ({:.0%}); {}".format(
+        matched, total, matched / total if total else 0, encode.format_print_time(counter.count, baud)),
+        file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
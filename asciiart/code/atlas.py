@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Compact binary "atlas" of the prepared character histograms.
+
+The prep scripts write the character HOGs as JSON (a dictionary of nested lists),
+which is slow to parse: the overstrike table is 4096 x 96 floats.
+They also write the same data as a binary atlas, which the renderers memory-map instead.
+
+File layout (little-endian):
+- header (32 bytes): magic, version, dtype, count, key length, feature shape, CRC32 of everything after the header
+- keys: count x key-length ASCII bytes, padded to a multiple of 8
+- luminances: count x float64, the mean of each character's histograms (computed before any rounding)
+- features: count x (BROWS x BCOLS x orientations), float32 (or float16), contiguous
+
+Convert an existing JSON file:
+    python atlas.py chars_ascii.json
+Check an atlas:
+    python atlas.py --check chars_overstrike.atlas
+"""
+
+import os
+import json
+import struct
+import zlib
+import collections
+import numpy as np
+import click
+import matcher
+
+
+MAGIC = b"ASR33HOG"
+VERSION = 1
+
+# magic, version, dtype, reserved, count, key length, brows, bcols, orientations, crc32
+HEADER = struct.Struct("<8sHBBIHHHHI")
+HEADER_SIZE = 32
+
+DTYPES = {4: np.float32, 2: np.float16}
+
+Atlas = collections.namedtuple("Atlas", ["keys", "features", "luminances", "checksum"])
+
+loaded_atlases = {}
+
+
+def atlas_filename(filename):
+    """The atlas file that goes with a prepared JSON file"""
+    return os.path.splitext(filename)[0] + ".atlas"
+
+
+def _pad8(n):
+    return (n + 7) // 8 * 8
+
+
+def write(filename, chars, dtype=np.float32):
+    """
+    Write the prepared character histograms as a binary atlas.
+    :param filename: output file
+    :param chars: dictionary of {character(s): histogram-block}
+    :param dtype: np.float32 or np.float16
+    """
+    dtype = np.dtype(dtype)
+    if dtype.itemsize not in DTYPES:
+        raise ValueError("Unsupported atlas dtype: {}".format(dtype))
+    keys = list(chars.keys())
+    keylen = max(len(c) for c in keys)
+    data = [np.asarray(chars[c], dtype=float) for c in keys]
+    luminances = np.array([d.mean() for d in data], dtype="<f8")
+    features = np.stack(data).astype(dtype.newbyteorder("<"))
+
+    keybytes = "".join(c.ljust(keylen) for c in keys).encode("ascii")
+    payload = keybytes.ljust(_pad8(len(keybytes)), b"\0") + luminances.tobytes() + features.tobytes()
+    header = HEADER.pack(MAGIC, VERSION, dtype.itemsize, 0, len(keys), keylen,
+                         *features.shape[1:], zlib.crc32(payload))
+    with open(filename, "wb") as afile:
+        afile.write(header.ljust(HEADER_SIZE, b"\0"))
+        afile.write(payload)
+
+
+def read(filename, verify=False):
+    """
+    Memory-map an atlas file.
+    :param filename: the atlas file
+    :param verify: check the CRC32 of the file contents
+    :return: Atlas(keys, features, luminances, checksum).  The features are a read-only memory map.
+    """
+    with open(filename, "rb") as afile:
+        header = afile.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError("Not an atlas file: {}".format(filename))
+        (magic, version, itemsize, _, count, keylen,
+         brows, bcols, orientations, checksum) = HEADER.unpack_from(header)
+        if magic != MAGIC:
+            raise ValueError("Not an atlas file: {}".format(filename))
+        if version != VERSION:
+            raise ValueError("Unsupported atlas version {}: {}".format(version, filename))
+        if itemsize not in DTYPES:
+            raise ValueError("Unsupported atlas dtype: {}".format(filename))
+        keybytes = afile.read(count * keylen)
+        if verify:
+            afile.seek(HEADER_SIZE)
+            if zlib.crc32(afile.read()) != checksum:
+                raise ValueError("Atlas checksum mismatch: {}".format(filename))
+
+    keys = [keybytes[i: i + keylen].decode("ascii") for i in range(0, count * keylen, keylen)]
+    offset = HEADER_SIZE + _pad8(count * keylen)
+    luminances = np.fromfile(filename, dtype="<f8", count=count, offset=offset)
+    offset += count * 8
+    features = np.memmap(filename, dtype=np.dtype(DTYPES[itemsize]).newbyteorder("<"), mode="r",
+                         offset=offset, shape=(count, brows, bcols, orientations))
+    return Atlas(keys, features, luminances, "{:08x}".format(checksum))
+
+
+def read_json(filename):
+    """
+    Read the prepared JSON file.  Its checksum is the CRC32 of the file.
+    :return: Atlas(keys, features, luminances, checksum)
+    """
+    with open(filename, "rb") as data:
+        raw = data.read()
+    keys, features, luminances = matcher.stack_chars(json.loads(raw))
+    return Atlas(keys, features, luminances, "{:08x}".format(zlib.crc32(raw)))
+
+
+def load(filename):
+    """
+    Load the prepared character histograms for a JSON file.
+    Use the binary atlas if there's one that's at least as new as the JSON, otherwise parse the JSON.
+    Results are cached, so that repeated renders in one process don't reload.
+    :param filename: the JSON filename, e.g. "chars_overstrike.json"
+    :return: Atlas(keys, features, luminances, checksum)
+    """
+    binary = atlas_filename(filename)
+    use_binary = os.path.isfile(binary) and (not os.path.isfile(filename) or
+                                             os.path.getmtime(binary) >= os.path.getmtime(filename))
+    source = binary if use_binary else filename
+    stamp = (source, os.path.getmtime(source))
+    if stamp not in loaded_atlases:
+        loaded_atlases[stamp] = read(binary) if use_binary else read_json(filename)
+    return loaded_atlases[stamp]
+
+
+def select(atlas, mask):
+    """
+    A subset of the atlas.
+    :param atlas: Atlas
+    :param mask: boolean array, or list, with one entry per key
+    :return: Atlas with only the selected keys
+    """
+    mask = np.asarray(mask, dtype=bool)
+    keys = [c for (c, m) in zip(atlas.keys, mask) if m]
+    return Atlas(keys, atlas.features[mask], atlas.luminances[mask], atlas.checksum)
+
+
+@click.command()
+@click.option('--float16', is_flag=True, default=False, help='Store the features as float16 (half the size)')
+@click.option('--check', is_flag=True, default=False, help='Verify an atlas file and print its summary')
+@click.argument('filename')
+def main(filename, float16, check):
+    """Convert a prepared JSON file to a binary atlas (or check an atlas)."""
+    if check:
+        atl = read(filename, verify=True)
+        print("{}: {} keys, features {} {}, checksum {}".format(
+            filename, len(atl.keys), atl.features.shape[1:], atl.features.dtype, atl.checksum))
+        return
+    with open(filename, "rb") as data:
+        chars = json.load(data)
+    outfile = atlas_filename(filename)
+    write(outfile, chars, dtype=np.float16 if float16 else np.float32)
+    print("Wrote {} ({} keys)".format(outfile, len(chars)))
+
+
+if __name__ == "__main__":
+    main()
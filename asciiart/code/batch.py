@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Render a whole collection of pictures with image2, in a pool of worker processes.
+
+Running image2.py once per file spends more time starting up (importing skimage, loading the atlas)
+than rendering a small picture.  This starts once, loads the atlas once (the workers share it),
+and renders each picture to its own text file, with the same framing as image2.py:
+    python batch.py --width 40 ../emoji
+    python batch.py --width 66 --output-dir prints "../album_covers/*_250.jpg"
+
+At the end it writes a manifest (JSON) with the time taken for each file, and any errors.
+With --profile, the manifest also has the time spent in each stage (see instrument.py), for each file
+and added up over all of them.
+"""
+
+import os
+import sys
+import io
+import json
+import glob
+import time
+import multiprocessing
+import click
+import atlas
+import image2
+import instrument
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp")
+
+
+def find_images(paths):
+    """
+    :param paths: filenames, directories (all the images in them), or glob patterns
+    :return: sorted list of image filenames
+    """
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found.update(os.path.join(path, name) for name in os.listdir(path)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        elif os.path.exists(path):
+            found.add(path)
+        else:
+            found.update(glob.glob(path))
+    return sorted(found)
+
+
+def output_filename(filename, output_dir=None):
+    """The text file for an image: filename + ".txt", like image2.py, in the output directory if there is one"""
+    if output_dir:
+        return os.path.join(output_dir, os.path.basename(filename) + ".txt")
+    return filename + ".txt"
+
+
+def render_file(task):
+    """
+    Render one image (in a worker process).
+    :param task: (image filename, text filename, rendering options, whether to profile)
+    :return: manifest entry, {file, output, time, error}, and the stages (if profiling)
+    """
+    (filename, output, options, profile) = task
+    started = time.time()
+    options = dict(options)
+    (width, invert, gamma, title) = (options.pop(k) for k in ("width", "invert", "gamma", "title"))
+    profiler = instrument.Profiler() if profile else None
+    try:
+        with instrument.profiling(profiler):
+            fd = image2.process(image2.load_image(filename, width, invert, gamma))
+            if title:
+                title = image2.format_title(title, width, options["indent"])
+            rows = image2.render_rows(fd, **options)
+            with io.open(output, "wb") as f:
+                image2.write_rows(rows, f, title)
+        error = None
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    result = dict(file=filename, output=output, time=time.time() - started, error=error)
+    if profiler is not None:
+        result["stages"] = profiler.totals
+    return result
+
+
+def render_all(filenames, output_dir, options, workers=None, profile=False):
+    """
+    :param profile: True to time the stages of each file
+    :return: the manifest entries, one per file (in the order of the filenames)
+    """
+    # Load the atlases before starting the pool, so that the workers don't each load them again
+    atlas.load(image2.PREPARED_FILE)
+    if options.get("layers", image2.ROUNDS) > 2:
+        atlas.load(image2.SINGLES_FILE)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    tasks = [(filename, output_filename(filename, output_dir), options, profile) for filename in filenames]
+    results = {}
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(render_file, tasks):
+            results[result["file"]] = result
+            print("{}: {}".format(result["file"], "{:.2f}s".format(result["time"]) if result["error"] is None
+                                  else result["error"].splitlines()[0]), file=sys.stderr)
+    return [results[filename] for filename in filenames]
+
+
+@click.command()
+@click.option('--width', default=66, help='Image width (characters)')
+@click.option('--invert', is_flag=True, default=False, help='Invert colors')
+@click.option('--gamma', default=1.0, help='Gamma correction')
+@click.option('--indent', default=0, help='Indent with spaces')
+@click.option('--chars1', help='Characters to use in the first layer')
+@click.option('--chars2', help='Characters to use in the second layer')
+@click.option('--title', help='Title text (the same for every picture)')
+@click.option('--search', type=click.Choice(["brute", "index"]), default="brute",
+              help='Compare with every character, or use the nearest-neighbour index')
+@click.option('--approximate', default=0.0, help='Index search tolerance (0 = exact)')
+@click.option('--layers', type=click.IntRange(2, 3), default=image2.ROUNDS, help='Layers of overstrike (3 for triple-strike)')
+@click.option('--chars3', help='Characters to use in the third layer')
+@click.option('--beam', type=click.IntRange(1), default=8,
+              help='Triple-strike: how many character-pairs to extend for each block')
+@click.option('--workers', type=int, help='Number of processes (default: one per CPU)')
+@click.option('--output-dir', help='Directory for the text files (default: next to each picture)')
+@click.option('--manifest', help='Manifest filename (default: manifest.json in the output directory)')
+@click.option('--profile', is_flag=True, default=False, help='Record the time spent in each stage in the manifest')
+@click.argument('paths', nargs=-1, required=True)
+def main(width, invert, gamma, indent, chars1, chars2, title, search, approximate, layers, chars3, beam,
+         workers, output_dir, manifest, profile, paths):
+    """Render all the pictures in PATHS (files, directories, or glob patterns)."""
+    if layers > 2 and (search != "brute" or approximate):
+        raise click.UsageError("--layers 3 compares with every character, "
+                               "so it can't use --search index or --approximate")
+    filenames = find_images(paths)
+    if not filenames:
+        raise click.UsageError("No images found")
+
+    options = dict(width=width, invert=invert, gamma=gamma, indent=indent, chars1=chars1, chars2=chars2,
+                   title=title, search=search, approximate=approximate, layers=layers, chars3=chars3, beam=beam)
+    started = time.time()
+    results = render_all(filenames, output_dir, options, workers, profile)
+    elapsed = time.time() - started
+
+    if not manifest:
+        manifest = os.path.join(output_dir or ".", "manifest.json")
+    failures = [result for result in results if result["error"] is not None]
+    summary = dict(options=options, time=elapsed, files=results, failures=len(failures))
+    if profile:
+        # The stages added up over all the files (their CPU time, not the elapsed time of the pool)
+        totals = instrument.Profiler()
+        for result in results:
+            totals.add_totals(result["stages"])
+        summary["stages"] = totals.totals
+    with io.open(manifest, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print("Rendered {} of {} pictures in {:.1f}s, manifest in {}".format(
+        len(results) - len(failures), len(results), elapsed, manifest), file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
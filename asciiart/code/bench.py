@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Benchmarks for the renderers and the prep scripts, to check that a change makes things faster
+(or at least no slower) without changing what's printed.
+
+    python bench.py run --output before.json
+    ... change something ...
+    python bench.py run --output after.json
+    python bench.py compare before.json after.json
+
+"run" renders each input with image1 and image2 at each width (32, 40, 66 and 72 by default),
+timing the whole render and each stage (see instrument.py), best of --repeat runs,
+and builds the overstrike atlas from chars_overstrike.jpg (in a temporary directory, without the cache).
+The inputs are some synthetic pictures (a gradient, a checkerboard, and smoothed noise),
+which are the same every time, and the album covers.  The results are saved as JSON, with a hash
+of each text file and some details of the machine (only compare results from the same machine).
+
+"compare" shows the change in time for each benchmark, and fails (exit status 1) if anything is slower
+by more than --threshold, or if any of the text is different.
+"""
+
+import os
+import sys
+import io
+import json
+import glob
+import time
+import hashlib
+import platform
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import scipy
+import skimage
+import imageio
+import click
+import instrument
+import image1
+import image2
+import prep_overstrike
+import bench_workers
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PICTURES = os.path.join(HERE, "..", "album_covers", "*_250.jpg")
+WIDTHS = (32, 40, 66, 72)
+
+
+def gradient(size=256):
+    """Diagonal gradient, dark to light"""
+    (y, x) = np.mgrid[0:size, 0:size]
+    return (x + y) / (2.0 * (size - 1))
+
+
+def checkerboard(size=256, square=16):
+    (y, x) = np.mgrid[0:size, 0:size]
+    return ((x // square + y // square) % 2).astype(float)
+
+
+def noise(size=256):
+    """Smoothed noise, with some structure at several scales"""
+    return bench_workers.poster(size, size)[:, :, 0]
+
+
+SYNTHETIC = dict(gradient=gradient, checkerboard=checkerboard, noise=noise)
+
+
+def write_inputs(directory, pictures):
+    """
+    Write the synthetic pictures (as RGB PNG, since the renderers read files) next to the real ones.
+    :return: dictionary of {input name: filename}
+    """
+    inputs = {}
+    for (name, make) in SYNTHETIC.items():
+        inputs[name] = os.path.join(directory, name + ".png")
+        imageio.imwrite(inputs[name], (np.dstack([make()] * 3) * 255).round().astype(np.uint8))
+    for filename in pictures:
+        inputs[os.path.basename(filename)] = filename
+    return inputs
+
+
+def machine():
+    """Details of where the benchmarks ran"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE,
+                                         stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(platform=platform.platform(), machine=platform.machine(), processor=platform.processor(),
+                cpus=os.cpu_count(), python=platform.python_version(), numpy=np.__version__,
+                scipy=scipy.__version__, skimage=skimage.__version__, commit=commit,
+                date=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def best_of(repeat, run):
+    """
+    :param run: function to run with a Profiler active, returning the text
+    :return: (best time, the stage times of that run, the text)
+    """
+    best = None
+    for _ in range(repeat):
+        profiler = instrument.Profiler()
+        started = time.perf_counter()
+        with instrument.profiling(profiler):
+            text = run()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best[0]:
+            best = (elapsed, {name: total["wall"] for (name, total) in profiler.totals.items()}, text)
+    return best
+
+
+def render_image1(filename, width):
+    """Render with image1, as image1.py does, :return: the text"""
+    fd = image1.process(image1.load_image(filename, width, False, 1.0))
+    with tempfile.TemporaryDirectory() as directory:
+        outfile = os.path.join(directory, "out.txt")
+        # image1 prints each layer as it goes, and the print time
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            image1.render(fd, 2, outfile)
+        with io.open(outfile, "rb") as f:
+            return f.read()
+
+
+def render_image2(filename, width):
+    """Render with image2, as image2.py does (without the title), :return: the text"""
+    fd = image2.process(image2.load_image(filename, width, False, 1.0))
+    text = io.BytesIO()
+    image2.write_rows(image2.render_rows(fd, None, None, 0, "brute"), text)
+    return text.getvalue()
+
+
+RENDERERS = dict(image1=render_image1, image2=render_image2)
+
+
+def build_atlas():
+    """Build the overstrike atlas from the scan, in a temporary directory, :return: the JSON"""
+    with tempfile.TemporaryDirectory() as directory:
+        os.symlink(os.path.join(HERE, "chars_overstrike.jpg"), os.path.join(directory, "chars_overstrike.jpg"))
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                prep_overstrike.analyze_table_image(cache_dir=None)
+            with io.open("chars_overstrike.json", "rb") as f:
+                return f.read()
+        finally:
+            os.chdir(cwd)
+
+
+def result(renderer, name, width, timing):
+    (elapsed, stages, text) = timing
+    print("{:16} {:24} {:>5} {:7.3f}s  {}".format(renderer, name, width or "-", elapsed, "  ".join(
+        "{} {:.3f}".format(stage, t) for (stage, t) in stages.items())), file=sys.stderr)
+    return dict(renderer=renderer, input=name, width=width, time=elapsed, stages=stages,
+                sha256=hashlib.sha256(text).hexdigest(), bytes=len(text))
+
+
+def key(r):
+    return "{} {} {}".format(r["renderer"], r["input"], r["width"] or "-")
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option('--width', 'widths', multiple=True, type=int, help='Image width (characters), can be repeated')
+@click.option('--renderer', 'renderers', multiple=True, type=click.Choice(["image1", "image2"]),
+              help='Renderers to time, can be repeated (default: both)')
+@click.option('--repeat', default=3, help='Best of this many runs')
+@click.option('--atlas/--no-atlas', default=True, help='Time building the atlas from the scan')
+@click.option('--output', default="bench.json", help='Results filename')
+@click.argument('pictures', nargs=-1)
+def run(widths, renderers, repeat, atlas, output, pictures):
+    """Run the benchmarks (with the album covers, or PICTURES, as well as the synthetic inputs)."""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = write_inputs(directory, pictures or sorted(glob.glob(PICTURES)))
+        for renderer in renderers or RENDERERS:
+            render = RENDERERS[renderer]
+            for (name, filename) in inputs.items():
+                for width in widths or WIDTHS:
+                    timing = best_of(repeat, lambda: render(filename, width))
+                    results.append(result(renderer, name, width, timing))
+
+    if atlas:
+        results.append(result("prep_overstrike", "chars_overstrike.jpg", None, best_of(1, build_atlas)))
+
+    with io.open(output, "w") as f:
+        json.dump(dict(machine=machine(), repeat=repeat, results=results), f, indent=2)
+    print("Results in {}".format(output), file=sys.stderr)
+
+
+@main.command()
+@click.option('--threshold', default=0.1, help='Fraction slower that counts as a regression')
+@click.option('--min-time', default=0.01, help="Ignore stages that take less than this (seconds), they're noise")
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+def compare(threshold, min_time, before, after):
+    """Compare two sets of results (from "run")."""
+    (before, after) = (json.load(before), json.load(after))
+    if before["machine"]["platform"] != after["machine"]["platform"] or \
+            before["machine"]["cpus"] != after["machine"]["cpus"]:
+        print("Warning: the results are from different machines", file=sys.stderr)
+
+    old = {key(r): r for r in before["results"]}
+    problems = 0
+    print("{:48} {:>8} {:>8} {:>7}".format("benchmark", "before", "after", "change"))
+    for r in after["results"]:
+        name = key(r)
+        if name not in old:
+            print("{:48} {:>8} {:7.3f}s".format(name, "-", r["time"]))
+            continue
+        o = old.pop(name)
+        notes = []
+        if r["time"] > o["time"] * (1 + threshold):
+            notes.append("SLOWER")
+        for (stage, t) in r["stages"].items():
+            was = o["stages"].get(stage)
+            if was is not None and max(t, was) >= min_time and t > was * (1 + threshold):
+                notes.append("{} slower ({:.3f}s -> {:.3f}s)".format(stage, was, t))
+        if r["sha256"] != o["sha256"]:
+            notes.append("OUTPUT CHANGED")
+        problems += bool(notes)
+        print("{:48} {:7.3f}s {:7.3f}s {:+6.1%}  {}".format(name, o["time"], r["time"],
+                                                              r["time"] / o["time"] - 1, ", ".join(notes)))
+    for name in old:
+        print("{:48} {:7.3f}s {:>8}".format(name, old[name]["time"], "-"))
+
+    if problems:
+        print("{} benchmarks slower or changed".format(problems), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""How the matching in image2 scales with --workers.
+
+The image is analyzed once, then matched with each number of workers, and the text is checked
+to be the same as the single-process result.  With no filename, this uses a synthetic "poster"
+(smoothed noise, three times as tall as it is wide), which is the slow case.
+    python bench_workers.py --width 72 --workers 1 --workers 2 --workers 4 --workers 8
+"""
+
+import time
+import numpy as np
+import click
+import image2
+from scipy import ndimage as ndi
+
+
+def poster(rows=3000, cols=1000, seed=0):
+    """A synthetic image (gray, as RGB) with some structure at several scales"""
+    noise = np.random.RandomState(seed).rand(rows, cols)
+    img = ndi.gaussian_filter(noise, 4) + ndi.gaussian_filter(noise, 16) + ndi.gaussian_filter(noise, 64)
+    img = (img - img.min()) / (img.max() - img.min())
+    return np.dstack([img] * 3)
+
+
+def time_render(fd, workers, repeat, **options):
+    """:return: (best time in seconds, the rows of text)"""
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        rows = list(image2.render_rows(fd, workers=workers, **options))
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+@click.command()
+@click.option('--width', default=72, help='Image width (characters)')
+@click.option('--workers', 'counts', multiple=True, type=click.IntRange(1), help='Worker counts to try')
+@click.option('--layers', type=click.IntRange(2, 3), default=image2.ROUNDS, help='Layers of overstrike')
+@click.option('--repeat', default=3, help='Best of this many runs')
+@click.argument('filename', required=False)
+def main(width, counts, layers, repeat, filename):
+    source = poster() if filename is None else filename
+    fd = image2.process(image2.load_image(source, width, False, 1.0))
+    print("{} rows of {} characters, {} layers".format(fd.shape[0] // image2.BROWS, width, layers))
+
+    options = dict(chars1=None, chars2=None, layers=layers)
+    (serial, expected) = time_render(fd, 1, repeat, **options)
+    print("{:>7} {:>8} {:>7}".format("workers", "time", "speedup"))
+    print("{:7d} {:7.2f}s {:6.2f}x".format(1, serial, 1.0))
+    for workers in counts or (2, 4, 8):
+        if workers == 1:
+            continue
+        (elapsed, rows) = time_render(fd, workers, repeat, **options)
+        print("{:7d} {:7.2f}s {:6.2f}x{}".format(workers, elapsed, serial / elapsed,
+                                                  "" if rows == expected else "  DIFFERENT OUTPUT"))
+
+
+if __name__ == "__main__":
+    main()
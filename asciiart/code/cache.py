@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""A cache of rendered text, so that the same picture with the same options isn't rendered twice.
+
+Each entry is keyed by a hash of
+- the decoded image pixels (so it doesn't matter what the file is called, or how it was compressed),
+- all the rendering options, and
+- the checksums of the character atlases,
+and stores the exact bytes that were written, with all the CR-overstrike and framing.
+
+The entries are files in the cache directory.  Reading an entry touches it, and when the directory grows
+past its size limit, the least-recently-used entries are removed.  The hit and miss counts are kept in
+the directory too, so they add up across runs (and processes using the same directory at once take turns
+to update them, with a lock file).  To see them:
+    python cache.py ~/.cache/asciiart
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+import contextlib
+import numpy as np
+import click
+
+
+# Change this when the rendering changes, to ignore the old entries
+VERSION = 2
+
+MAX_SIZE = 64 * 1024 * 1024
+
+STATS_FILE = "stats.json"
+LOCK_FILE = "stats.lock"
+
+
+class RenderCache(object):
+
+    def __init__(self, directory, max_size=MAX_SIZE):
+        """
+        :param directory: where to keep the entries (created if necessary)
+        :param max_size: total size of the entries (bytes), above which the least-recently-used are removed
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(pixels, options, checksums):
+        """
+        :param pixels: the decoded image (numpy array)
+        :param options: dictionary of rendering options
+        :param checksums: checksums of the atlases used
+        :return: the key (hex string)
+        """
+        pixels = np.ascontiguousarray(pixels)
+        h = hashlib.sha256()
+        h.update(json.dumps([VERSION, pixels.shape, pixels.dtype.str, options, checksums],
+                            sort_keys=True).encode("utf-8"))
+        h.update(pixels.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".txt")
+
+    def get(self, key):
+        """
+        :return: the stored text (bytes), or None if it isn't in the cache
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                text = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            text = None
+        self._count("misses" if text is None else "hits")
+        return text
+
+    def put(self, key, text):
+        """Store the text (bytes), then evict the least-recently-used entries if the cache is too big"""
+        (fd, temp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(text)
+        os.replace(temp, self._path(key))
+        self.evict()
+
+    def entries(self):
+        """:return: list of (mtime, size, path) for each entry, oldest first"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".txt"):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least-recently-used entries until the total size is within the limit"""
+        entries = self.entries()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        """:return: dictionary of hits, misses, entries and size"""
+        stats = self._read_counts()
+        entries = self.entries()
+        stats["entries"] = len(entries)
+        stats["size"] = sum(size for (_, size, _) in entries)
+        return stats
+
+    def clear(self):
+        """Remove all the entries, and reset the counts"""
+        for (_, _, path) in self.entries():
+            os.unlink(path)
+        with self._locked():
+            self._write_counts({"hits": 0, "misses": 0})
+
+    def _read_counts(self):
+        try:
+            with open(os.path.join(self.directory, STATS_FILE)) as f:
+                counts = json.load(f)
+        except (FileNotFoundError, ValueError):
+            counts = {}
+        return {"hits": counts.get("hits", 0), "misses": counts.get("misses", 0)}
+
+    def _write_counts(self, counts):
+        (fd, temp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(counts, f)
+        os.replace(temp, os.path.join(self.directory, STATS_FILE))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the counts, against other threads and other processes (e.g. image2.py --cache run by renderc)"""
+        with self.lock, open(os.path.join(self.directory, LOCK_FILE), "a") as f:
+            # (The lock is released when the file is closed)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _count(self, name):
+        with self._locked():
+            counts = self._read_counts()
+            counts[name] += 1
+            self._write_counts(counts)
+
+
+@click.command()
+@click.option('--clear', is_flag=True, default=False, help='Remove all the entries')
+@click.argument('directory')
+def main(directory, clear):
+    """Show the hits and misses for a render cache."""
+    render_cache = RenderCache(directory)
+    if clear:
+        render_cache.clear()
+    stats = render_cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    print("{}: {} entries, {:.1f}KB; {} hits, {} misses ({:.0%} hit rate)".format(
+        render_cache.directory, stats["entries"], stats["size"] / 1024, stats["hits"], stats["misses"],
+        stats["hits"] / lookups if lookups else 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Nearest-neighbour index over the character histograms, with luminance-bounded queries.
+
+The question the renderer asks for each block is
+    "which character's HOG is closest to this block, among the characters whose luminance is at most X"
+(where X is the block's mean, so that we don't print more ink than the block needs).
+
+The index sorts the characters by luminance and splits them into buckets of similar luminance.
+Each bucket has a KD-tree and a bounding box.  For a query:
+- buckets entirely below the luminance limit are searched with their KD-tree,
+  unless the bounding box shows they can't contain anything closer than the best so far;
+- the one bucket that straddles the limit is searched by brute force over its eligible characters;
+- buckets above the limit are never touched.
+
+With eps=0 the search is exact (same result as the exhaustive search, including ties,
+which go to the first character in atlas order).  With eps>0 it's approximate: each result
+is within a factor (1 + eps) of the true nearest distance, and more of the index is pruned.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+BUCKET_SIZE = 256
+
+# How many neighbours to ask the KD-trees for, to find the ties for nearest (which go to the first in atlas order).
+# If they're all tied, there may be more, so the bucket is searched by brute force for that block.
+TIES = 8
+
+built_indexes = {}
+
+
+def distance(a, b):
+    """Euclidean distance along the last axis (the same way everywhere, so that equal distances compare equal)"""
+    diff = a - b
+    return np.sqrt((diff * diff).sum(axis=-1))
+
+
+class CharIndex(object):
+
+    def __init__(self, features, luminances, bucket_size=BUCKET_SIZE):
+        """
+        :param features: (N, brows, bcols, orientations) character histograms
+        :param luminances: (N,) luminance of each character
+        :param bucket_size: number of characters per luminance bucket
+        """
+        self.order = np.argsort(luminances, kind="stable")
+        # Where each character is in the order
+        self.rank = np.argsort(self.order)
+        self.luminances = np.asarray(luminances)[self.order]
+        self.points = np.asarray(features, dtype=float).reshape(len(features), -1)[self.order]
+        self.buckets = []
+        for start in range(0, len(self.order), bucket_size):
+            end = min(start + bucket_size, len(self.order))
+            points = self.points[start: end]
+            self.buckets.append((start, end, points.min(axis=0), points.max(axis=0), cKDTree(points)))
+
+    def _update(self, best_dist, best_index, rows, dist, index):
+        """Keep the better of (best_dist, best_index) and (dist, index) for the given rows; ties go to lower index"""
+        better = (dist < best_dist[rows]) | ((dist == best_dist[rows]) & (index < best_index[rows]))
+        rows = rows[better]
+        best_dist[rows] = dist[better]
+        best_index[rows] = index[better]
+
+    def query(self, blocks, limits, eps=0.0):
+        """
+        Find the nearest character to each block, among those with luminance <= limit.
+        :param blocks: (B, brows, bcols, orientations)
+        :param limits: (B,) the luminance limit for each block
+        :param eps: 0 for an exact search, >0 for approximate
+        :return: (B,) index of the best character (in the original atlas order), or -1 where there's no candidate.
+        """
+        query = np.asarray(blocks, dtype=float).reshape(len(blocks), -1)
+        eligible = np.searchsorted(self.luminances, limits, side="right")
+        best_dist = np.full(len(query), np.inf)
+        best_index = np.full(len(query), len(self.order))
+        # The best match is usually close to the luminance limit, so start from the darkest buckets:
+        # that finds a good match early, and then the bounding boxes prune more of the lighter buckets.
+        for (start, end, lower, upper, tree) in reversed(self.buckets):
+            # Blocks that can use some of this bucket
+            rows = np.nonzero(eligible > start)[0]
+            if len(rows) == 0:
+                continue
+            # Skip blocks where the bucket's bounding box is already further away than the best match
+            gap = np.maximum(lower - query[rows], 0) + np.maximum(query[rows] - upper, 0)
+            bound = np.sqrt(np.einsum("ij,ij->i", gap, gap)) * (1 + eps)
+            rows = rows[bound <= best_dist[rows]]
+
+            # The whole bucket is below the luminance limit: use the tree
+            whole = rows[eligible[rows] >= end]
+            overflow = whole[:0]
+            if len(whole):
+                k = min(TIES, end - start)
+                dist, found = tree.query(query[whole], k=k, eps=eps)
+                (dist, found) = (dist.reshape(len(whole), k), found.reshape(len(whole), k))
+                # Of the neighbours at the nearest distance, the first in atlas order
+                tied = dist == dist[:, :1]
+                index = np.where(tied, self.order[start + found], len(self.order)).min(axis=1)
+                self._update(best_dist, best_index, whole, distance(query[whole], self.points[self.rank[index]]),
+                             index)
+                if k < end - start:
+                    overflow = whole[tied[:, -1]]
+
+            # The bucket straddles the luminance limit (or has more ties than the tree found): brute force, masked
+            part = np.concatenate([rows[eligible[rows] < end], overflow])
+            if len(part):
+                dist = distance(query[part][:, None, :], self.points[start: end][None, :, :])
+                dist[np.arange(start, end)[None, :] >= eligible[part][:, None]] = np.inf
+                # Columns in atlas order, so that argmin breaks ties the same way as the exhaustive search
+                columns = np.argsort(self.order[start: end])
+                dist = dist[:, columns]
+                nearest = np.argmin(dist, axis=1)
+                self._update(best_dist, best_index, part,
+                             dist[np.arange(len(part)), nearest], self.order[start: end][columns][nearest])
+
+        best_index[np.isinf(best_dist)] = -1
+        return best_index
+
+    def best_matches(self, blocks, gate=1.0, eps=0.0):
+        """
+        Same as matcher.best_matches, using the index.
+        :param blocks: (B, brows, bcols, orientations)
+        :param gate: a character is a candidate if the block's mean >= gate * its luminance
+        :param eps: 0 for an exact search, >0 for approximate
+        :return: (B,) index of the best character for each block, or -1 where there's no candidate.
+        """
+        means = np.asarray(blocks).reshape(len(blocks), -1).mean(axis=1)
+        return self.query(blocks, means / gate, eps=eps)
+
+
+def get(chars):
+    """
+    Build (or reuse) the index for a set of characters.
+    Indexes are cached by atlas checksum and selected keys, so each atlas and --chars1/--chars2 filter is indexed once.
+    :param chars: atlas.Atlas
+    :return: CharIndex
+    """
+    key = (chars.checksum, tuple(chars.keys))
+    if key not in built_indexes:
+        built_indexes[key] = CharIndex(chars.features, chars.luminances)
+    return built_indexes[key]
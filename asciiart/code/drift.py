@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Check how much image2 --float32 changes the output.
+
+Single precision changes the HOG by rounding.  That's enough to change some of the characters,
+because the gradients of the dots (and of other flat areas) point exactly along the rows or columns,
+which is the boundary between two orientation bins, so rounding noise decides which bin they go in.
+The same is true in double precision: nudging the image by 1e-12 changes about as many blocks.
+So for each picture this measures
+- how many blocks print differently in float32,
+- how many print differently in float64 after adding +/-1e-12 of noise to the image (the noise floor), and
+- how well the printed luminance matches the image (the correlation, as in sweep.py), both ways;
+and fails (exit status 1) if float32 changes more blocks than the noise floor, or the match gets worse
+by more than --match-bound.  (Float32 is a little worse: the gradients of flat areas are exactly on the bin
+boundaries, so they all go into the same bin, where in float64 the noise spreads them between the two.)
+To check some pictures:
+    python drift.py --width 40 --width 72 ../album_covers/*_250.jpg
+(test_drift.py checks the same bound on some synthetic pictures.)
+"""
+
+import sys
+import numpy as np
+import click
+import atlas
+import matcher
+import image2
+
+
+# The largest acceptable loss of tone-match in float32
+MATCH_BOUND = 0.015
+
+
+def strikes(img, chars):
+    """:return: (the block luminances, the strikes for every block)"""
+    blocks = matcher.blocks(image2.process(img.copy()), image2.BROWS, image2.BCOLS)
+    blocks = blocks.reshape((-1,) + blocks.shape[2:])
+    return blocks.reshape(len(blocks), -1).mean(axis=1), np.array(chars.strikes(blocks))
+
+
+def tone_match(target, printed):
+    """The correlation between the luminance of the image blocks and the printed characters"""
+    lums = atlas.load(image2.PREPARED_FILE)
+    lums = dict(zip(lums.keys, lums.luminances))
+    return float(np.corrcoef(target, [lums.get(pair, 0.0) for pair in printed])[0, 1])
+
+
+def drift(filename, width, chars64, chars32, noise=1e-12):
+    """:return: dictionary of changed (fraction of blocks, float32), floor (fraction, float64 + noise),
+                match64 and match32"""
+    img = image2.load_image(filename, width, False, 1.0)
+    (target, strikes64) = strikes(img, chars64)
+    (_, strikes32) = strikes(image2.load_image(filename, width, False, 1.0, np.float32), chars32)
+    (_, nudged) = strikes(img + np.random.RandomState(0).uniform(-noise, noise, img.shape), chars64)
+    return dict(changed=float((strikes32 != strikes64).mean()), floor=float((nudged != strikes64).mean()),
+                match64=tone_match(target, strikes64), match32=tone_match(target, strikes32))
+
+
+def acceptable(d, match_bound=MATCH_BOUND):
+    """:return: True if float32 changes no more blocks than the noise floor, and the match is within the bound"""
+    return d["changed"] <= d["floor"] and d["match64"] - d["match32"] <= match_bound
+
+
+@click.command()
+@click.option('--width', 'widths', multiple=True, type=int, help='Image width (characters), can be repeated')
+@click.option('--match-bound', default=MATCH_BOUND, help='Largest acceptable loss of tone-match')
+@click.argument('filenames', nargs=-1, required=True)
+def main(widths, match_bound, filenames):
+    chars64 = image2.Matcher()
+    chars32 = image2.Matcher(dtype=np.float32)
+    failed = 0
+    for filename in filenames:
+        for width in widths or [40]:
+            d = drift(filename, width, chars64, chars32)
+            ok = acceptable(d, match_bound)
+            failed += not ok
+            print("{} width {}: {:.1%} of blocks changed (noise floor {:.1%}), match {:.4f} -> {:.4f}{}".format(
+                filename, width, d["changed"], d["floor"], d["match64"], d["match32"], "" if ok else "  FAIL"))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Encode the rendered layers in as few bytes as possible, because every byte takes time to print.
+
+At 110 baud the Teletype prints ten characters per second, and that includes the spaces and the CRs.
+Each row of the picture is several layers of text, printed one over the other with a CR between them.
+Overstrike doesn't care which pass a character was printed in, so for each column we move the characters
+up into the earliest layers, and only the columns with more than one character need the later passes.
+Then
+- trailing spaces are stripped from each layer,
+- a layer that's left empty isn't printed at all (and neither is its CR), and
+- where all the characters fit in one layer, the row is printed in one pass.
+"""
+
+BAUD = 110
+
+# Start bit, 7 data bits, parity, and two stop bits
+BITS_PER_CHAR = 11
+
+
+def pack(lines):
+    """
+    Move the characters in each column into the earliest layers.
+    :param lines: the text of each layer
+    :return: the layers, with trailing spaces stripped, and without any empty layers
+    """
+    width = max((len(line) for line in lines), default=0)
+    columns = [[c for c in column if c != " "] for column in zip(*(line.ljust(width) for line in lines))]
+    depth = max((len(column) for column in columns), default=0)
+    return ["".join(column[layer] if layer < len(column) else " " for column in columns).rstrip()
+            for layer in range(depth)]
+
+
+def encode_row(lines, indent=0):
+    """
+    :param lines: the text of each layer
+    :param indent: spaces before each layer
+    :return: the text to print for the row, with its layers separated by CR
+    """
+    return "\r".join((" " * indent) + line for line in pack(lines))
+
+
+def print_time(nbytes, baud=BAUD):
+    """:return: seconds to print this many bytes"""
+    return nbytes * BITS_PER_CHAR / baud
+
+
+def format_print_time(nbytes, baud=BAUD):
+    seconds = int(round(print_time(nbytes, baud)))
+    return "{} bytes, about {}m{:02d}s to print at {} baud".format(nbytes, seconds // 60, seconds % 60, baud)
+
+
+class Counter(object):
+    """A binary file that counts the bytes written to it, and passes them on"""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
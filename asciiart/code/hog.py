@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Histogram of oriented gradients for the fixed geometry that the renderers use.
+
+This computes the same histograms as
+    skimage.feature.hog(image, orientations, pixels_per_cell=(cell, cell), cells_per_block=(1, 1),
+                        block_norm=..., feature_vector=False)
+(squeezed to (rows, cols, orientations)), but
+- never builds the visualization image,
+- bins all the pixels at once with np.bincount instead of one pass per orientation, and
+- optionally scales each cell's histogram to the luminance of the cell, which the renderers need.
+
+The gradients are the same centered differences as skimage, and each pixel's orientation (0-180 degrees)
+votes its gradient magnitude into one bin.  skimage accumulates in single precision, we use double,
+so the results differ by rounding.  To see how much, on some sample images:
+    python hog.py ../album_covers/*_250.jpg
+"""
+
+import sys
+import numpy as np
+import click
+
+
+def gradients(image):
+    """Centered-difference gradients along rows and columns (zero at the edges, like skimage)"""
+    g_row = np.zeros_like(image)
+    g_row[1:-1, :] = image[2:, :] - image[:-2, :]
+    g_col = np.zeros_like(image)
+    g_col[:, 1:-1] = image[:, 2:] - image[:, :-2]
+    return g_row, g_col
+
+
+def histograms(image, cellsize=(16, 16), orientations=8):
+    """
+    Unnormalized orientation histograms for each cell.
+    :param image: 2D grayscale image (any size; the partial cells at the right and bottom are ignored)
+    :param cellsize: (rows, cols) pixels per cell
+    :param orientations: number of orientation bins over 0-180 degrees
+    :return: (n_cells_row, n_cells_col, orientations), the mean gradient magnitude in each bin
+    """
+    (c_row, c_col) = cellsize
+    n_cells_row = image.shape[0] // c_row
+    n_cells_col = image.shape[1] // c_col
+
+    g_row, g_col = gradients(image)
+    g_row = g_row[:n_cells_row * c_row, :n_cells_col * c_col]
+    g_col = g_col[:n_cells_row * c_row, :n_cells_col * c_col]
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+
+    # Each pixel's orientation bin.  Bin i is [i * width, (i + 1) * width),
+    # and the corrections make sure that rounding in the division doesn't move a pixel across a boundary.
+    width = 180. / orientations
+    bins = np.minimum((orientation / width).astype(int), orientations - 1)
+    bins -= orientation < bins * width
+    bins += (orientation >= (bins + 1) * width) & (bins < orientations - 1)
+
+    # Each pixel's cell, then accumulate (cell, bin) in one go
+    cell_row = np.arange(n_cells_row * c_row) // c_row
+    cell_col = np.arange(n_cells_col * c_col) // c_col
+    cells = cell_row[:, None] * n_cells_col + cell_col[None, :]
+    hist = np.bincount((cells * orientations + bins).ravel(), weights=magnitude.ravel(),
+                       minlength=n_cells_row * n_cells_col * orientations)
+    hist = hist.reshape(n_cells_row, n_cells_col, orientations) / (c_row * c_col)
+    return hist.astype(image.dtype, copy=False)
+
+
+def normalize(hist, block_norm="L1", eps=1e-5):
+    """Normalize each cell's histogram (1x1 blocks), the same way as skimage"""
+    if block_norm == "L1":
+        return hist / (np.abs(hist).sum(axis=-1, keepdims=True) + eps)
+    elif block_norm == "L2-Hys":
+        out = hist / np.sqrt((hist ** 2).sum(axis=-1, keepdims=True) + eps ** 2)
+        out = np.minimum(out, 0.2)
+        return out / np.sqrt((out ** 2).sum(axis=-1, keepdims=True) + eps ** 2)
+    raise ValueError("Unsupported block normalization: {}".format(block_norm))
+
+
+def cell_means(image, cellsize=(16, 16)):
+    """The mean of each cell of the image, (n_cells_row, n_cells_col)"""
+    (c_row, c_col) = cellsize
+    n_cells_row = image.shape[0] // c_row
+    n_cells_col = image.shape[1] // c_col
+    cells = image[:n_cells_row * c_row, :n_cells_col * c_col]
+    return cells.reshape(n_cells_row, c_row, n_cells_col, c_col).mean(axis=(1, 3))
+
+
+def scale_to_luminance(fd, luminance):
+    """
+    Scale each cell's histogram so that its mean is the luminance (in place).
+    :param fd: (rows, cols, orientations)
+    :param luminance: (rows, cols) luminance for each cell, or a single value for all of them
+    :return: fd
+    """
+    fd *= (luminance / (fd.mean(axis=-1) + sys.float_info.epsilon))[..., None]
+    return fd
+
+
+def hog(image, cellsize=16, orientations=8, block_norm="L1", luminance=True):
+    """
+    HOG for the renderers.
+    :param image: 2D grayscale image
+    :param cellsize: pixels per (square) cell
+    :param orientations: number of orientation bins
+    :param block_norm: "L1" or "L2-Hys"
+    :param luminance: scale each cell's histogram to the mean of the image cell
+    :return: (n_cells_row, n_cells_col, orientations)
+    """
+    fd = normalize(histograms(image, (cellsize, cellsize), orientations), block_norm)
+    if luminance:
+        scale_to_luminance(fd, cell_means(image, (cellsize, cellsize)))
+    return fd
+
+
+@click.command()
+@click.option('--width', default=40, help='Image width (characters)')
+@click.option('--block-norm', type=click.Choice(["L1", "L2-Hys"]), default="L1", help='Block normalization')
+@click.argument('filenames', nargs=-1)
+def main(width, block_norm, filenames):
+    """Compare with skimage.feature.hog on some images."""
+    import time
+    from skimage import feature
+    import image2
+
+    for filename in filenames:
+        image = image2.load_image(filename, width, False, 1.0)
+
+        started = time.time()
+        expected = feature.hog(image, orientations=8, pixels_per_cell=(16, 16), cells_per_block=(1, 1),
+                               block_norm=block_norm, visualize=True, feature_vector=False)[0]
+        expected = np.squeeze(expected)
+        t_skimage = time.time() - started
+
+        started = time.time()
+        actual = normalize(histograms(image, (16, 16), 8), block_norm)
+        t_hog = time.time() - started
+
+        diff = np.abs(actual - expected)
+        print("{}: max difference {:.3g}, mean {:.3g} (max value {:.3g}); skimage {:.3f}s, hog {:.3f}s".format(
+            filename, diff.max(), diff.mean(), np.abs(expected).max(), t_skimage, t_hog))
+
+
+if __name__ == "__main__":
+    main()
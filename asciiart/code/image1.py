@@ -31,11 +31,16 @@ Take care that empty image regions pick the "space" character!
 
 import os
 import sys
-import json
 import numpy as np
 import imageio
 import io
+import contextlib
 import click
+import atlas
+import matcher
+import hog
+import encode
+import instrument
 from skimage import feature, transform, color, exposure
 
 
@@ -45,7 +50,7 @@ BCOLS = 3
 
 
 HOG_ORIENTATIONS = 8
-VISUALIZE = True
+VISUALIZE = False  # True
 
 
 PREPARED_FILE = os.path.join(os.path.dirname(__file__), "chars_ascii.json")
@@ -60,32 +65,41 @@ LAYER_FACTOR = 0.5
 # Load and pre-process an image file
 def load_image(filename, width, invert, gamma):
     # Read the image
-    img = imageio.imread(filename)
+    with instrument.stage("decode"):
+        img = imageio.imread(filename)
 
-    if img.shape[-1] == 4:
-        # Blend the alpha channel
-        img = color.rgba2rgb(img)
+    with instrument.stage("grayscale"):
+        if img.shape[-1] == 4:
+            # Blend the alpha channel
+            img = color.rgba2rgb(img)
 
-    # Grayscale
-    img = color.rgb2gray(img)
+        # Grayscale
+        img = color.rgb2gray(img)
 
     # Resample and adjust the aspect ratio
     width_px = (3 * width) * 16
 
     img_width = 1.0 * width_px
     img_height = int(img.shape[0] * 3 * (img_width / (4 * img.shape[1])))
-    img = transform.resize(img, (img_height, img_width), anti_aliasing=True, mode='constant')
+    with instrument.stage("resize"):
+        img = transform.resize(img, (img_height, img_width), anti_aliasing=True, mode='constant')
 
-    # Adjust the exposure
-    img = exposure.adjust_gamma(img, gamma)
+    with instrument.stage("grayscale"):
+        # Adjust the exposure
+        img = exposure.adjust_gamma(img, gamma)
 
-    if invert:
-        img = 1 - img
+        if invert:
+            img = 1 - img
 
     return img
 
 
 def process(image):
+    with instrument.stage("hog"):
+        return hog_image(image)
+
+
+def hog_image(image):
     (rows, cols) = image.shape
     cellsize = 16
 
@@ -96,35 +110,26 @@ def process(image):
     if newshape != image.shape:
         image = np.resize(image, newshape)
 
-    # HOG the whole image
-    fd, img = feature.hog(image,
-                          orientations=HOG_ORIENTATIONS,
-                          pixels_per_cell=(cellsize, cellsize),
-                          cells_per_block=(1, 1),
-                          block_norm='L2-Hys',
-                          visualize=VISUALIZE,
-                          feature_vector=False)
-
-    # With 1x1 blocks we don't care about some of the fd dimensions
-    # Remove them for easier coding
-    fd = np.squeeze(fd)
-
-    # Normalize each histogram to the luminance of the block it derived from
-    n_cells_row = int(rows // cellsize)  # number of cells along row-axis
-    n_cells_col = int(cols // cellsize)  # number of cells along col-axis
-    for iy in range(0, n_cells_row):
-        for ix in range(0, n_cells_col):
-            px = ix * cellsize
-            py = iy * cellsize
-            cell = image[py: py + cellsize, px: px + cellsize]
-            luminance = cell.mean()
-            if VISUALIZE:
+    # HOG the whole image, with each histogram normalized to the luminance of the cell it derived from
+    fd = hog.hog(image, cellsize, HOG_ORIENTATIONS, block_norm='L2-Hys')
+
+    if VISUALIZE:
+        # Only skimage draws the image-of-HOG
+        _, img = feature.hog(image,
+                             orientations=HOG_ORIENTATIONS,
+                             pixels_per_cell=(cellsize, cellsize),
+                             cells_per_block=(1, 1),
+                             block_norm='L2-Hys',
+                             visualize=True,
+                             feature_vector=False)
+        for iy in range(0, image.shape[0] // cellsize):
+            for ix in range(0, image.shape[1] // cellsize):
+                px = ix * cellsize
+                py = iy * cellsize
+                luminance = image[py: py + cellsize, px: px + cellsize].mean()
                 hog_cell = img[py: py + cellsize, px: px + cellsize]
                 hog_cell *= luminance / (hog_cell.mean() + sys.float_info.epsilon)
 
-            fd_cell = fd[iy, ix]
-            fd_cell *= luminance / (fd_cell.mean() + sys.float_info.epsilon)
-
     if VISUALIZE:
         # Normalize the image-of-HOG and save it just so we can see
         img *= 1 / img.max()
@@ -133,88 +138,62 @@ def process(image):
     return fd
 
 
-def render(fd, layers, outfile, indent=0):
-    # The fd is a histograms-of-gradients
-    n_cells_row = fd.shape[0]
-    n_cells_col = fd.shape[1]
-
+def render(fd, layers, outfile, indent=0, baud=encode.BAUD):
     # Load the previously-prepared histograms for the print characters.
-    # This is structured as a dictionary, indexed by character, with each value being
-    # {
-    # "X": [
-    #       [
-    #        [ ... 8 histogram values ...],
-    #       ]
-    #      ],
-    # }
-    with open(PREPARED_FILE, "rb") as data:
-        chars = json.load(data)
-
-    # Make as numpy
-    for c in chars.keys():
-        chars[c] = np.array(chars[c])
-
-    charlums = {c: chars[c].mean() for c in chars.keys()}
-
-    # Make a place to hold characters
-    block = np.zeros((layers, n_cells_row // BROWS, n_cells_col // BCOLS), dtype=np.string_)
-
-    result = None
+    # This is indexed by character ("X"), with a (BROWS, BCOLS, HOG_ORIENTATIONS) histogram-block for each,
+    # memory-mapped from the binary atlas if there is one, otherwise read from the JSON.
+    with instrument.stage("atlas"):
+        chars = atlas.load(PREPARED_FILE)
+    keys, features, charlums = chars.keys, chars.features, chars.luminances
+    space = keys.index(' ')
+
+    # Which characters can be used on the first pass, and on the later passes
+    firstpass = np.array([c in FIRSTPASS_CHARS for c in keys])
+    nextpass = np.array([c in NEXT_PASS_CHARS for c in keys])
+
+    # The HOG as character-sized blocks.  This is a view, so subtracting ink from the blocks updates the fd.
+    fd_blocks = matcher.blocks(fd, BROWS, BCOLS)
+    (block_rows, block_cols) = fd_blocks.shape[:2]
+
+    # Make a place to hold characters (index into keys, for each layer and block)
+    block = np.zeros((layers, block_rows, block_cols), dtype=int)
+
+    passes = []
     for r in range(0, layers):
-        # Look at each 3x5 block in the HOG and match it to the best 3x5 block in the chars.
-        for ix in range(0, n_cells_col, BCOLS):
-            for iy in range(0, n_cells_row, BROWS):
-                fd_cell = fd[iy: iy+BROWS, ix: ix+BCOLS]
-
-                # Don't reuse the same character we printed in the previous pass
-                cprev = None
-                if r > 0:
-                    cprev = block[r-1, iy // BROWS, ix // BCOLS]
-
-                best = 1e10
-                char = ' '
-                # Look at each character to see whether it's a good match
-                for c in chars.keys():
-                    # On the first pass there's a subset of characters (to try make sure we get lots of letters)
-                    use_this = ((r == 0 and c in FIRSTPASS_CHARS) or (r > 0 and c in NEXT_PASS_CHARS)) and c != cprev
-                    # use_this = c != cprev
-                    # Our "best match" should be: highest correlation, and luminance not greater than necessary
-                    if use_this and fd_cell.mean() >= (charlums[c] * LAYER_FACTOR):
-                        # Correlation: use the L2 distance between the character's histogram and the HOG cell
-                        corr = np.linalg.norm(chars[c] - fd_cell)
-                        # print("{}: {} = {}: {}".format(c, chars[c].shape, fd_cell.shape, corr))
-                        if corr < best:
-                            best = corr
-                            char = c
-
-                block[r, iy//BROWS, ix//BCOLS] = char
-                # subtract the character-luminance so that the next round can tell where ink is still needed.
-                fd_cell -= (1-LAYER_FACTOR) * chars[char] #  + 0.25))
-                fd_cell.clip(min=0)
-
-        view = "S{}".format(n_cells_col//BCOLS)
-        lines = [s.tostring().decode("utf-8").rstrip() for s in block[r].view(view)]
+        # Look at each 3x5 block in the HOG and match it to the best 3x5 block in the chars, all at once.
+        cells = fd_blocks.reshape((block_rows * block_cols,) + fd_blocks.shape[2:])
+
+        # On the first pass there's a subset of characters (to try make sure we get lots of letters)
+        allowed = firstpass if r == 0 else nextpass
+        if r > 0:
+            # Don't reuse the same character we printed in the previous pass
+            cprev = block[r-1].reshape(-1)
+            allowed = allowed[None, :] & (np.arange(len(keys))[None, :] != cprev[:, None])
+
+        with instrument.stage("match"):
+            # Our "best match" should be: highest correlation, and luminance not greater than necessary
+            best = matcher.best_matches(cells, features, charlums, gate=LAYER_FACTOR, allowed=allowed)
+            best[best < 0] = space
+            block[r] = best.reshape(block_rows, block_cols)
+
+            # subtract the character-luminance so that the next round can tell where ink is still needed.
+            fd_blocks -= (1-LAYER_FACTOR) * features[block[r]]
+
+        lines = ["".join(keys[i] for i in row).rstrip() for row in block[r]]
         print("\n".join(lines))
         print("\n")
 
-        if result is None:
-            result = [(" " * indent) + line for line in lines]
-        else:
-            i = 0
-            for line in lines:
-                result[i] = result[i] + "\r" + (" " * indent) + line
-                i = i + 1
+        passes.append(lines)
+
+    # Each row is all the passes, one over the other (without the ones that would print nothing)
+    result = [encode.encode_row(layer_lines, indent) for layer_lines in zip(*passes)]
 
     # Write a text file with all the iterations
-    with io.open(outfile, "wb") as f:
-        f.write("\r\n".join(result).encode("utf-8"))
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
+    with instrument.stage("write"), io.open(outfile, "wb") as f:
+        counter = encode.Counter(f)
+        counter.write("\r\n".join(result).encode("utf-8"))
+        counter.write(b"\r\n" * 7)
+    print(encode.format_print_time(counter.count, baud), file=sys.stderr)
 
 
 @click.command()
@@ -223,18 +202,29 @@ def render(fd, layers, outfile, indent=0):
 @click.option('--gamma', default=1.0, help='gamma')
 @click.option('--indent', default=0, help='indent')
 @click.option('--layers', default=2, help='layers of overstrike')
+@click.option('--baud', default=encode.BAUD, help='Line speed, for the estimated print time')
+@click.option('--profile', help='Write the time spent in each stage to this file, as JSON lines ("-" for stderr)')
+@click.option('--profile-matcher', help='Write a cProfile dump of the matching to this file')
 @click.argument('filename')
-def main(filename, width, invert, gamma, indent, layers):
-    # Aspect ratio is determined by the input image.
-    # Width is determined here.
-    img = load_image(filename, width, invert, gamma)
-    imageio.imsave("test.jpg", img)
-
-    # Analyze the image
-    hog_fd = process(img)
-
-    # Map to ASCII
-    render(hog_fd, layers, filename + ".txt", indent)
+def main(filename, width, invert, gamma, indent, layers, baud, profile, profile_matcher):
+    profiler = instrument.Profiler(["match"] if profile_matcher else ()) if profile or profile_matcher else None
+    with instrument.profiling(profiler):
+        # Aspect ratio is determined by the input image.
+        # Width is determined here.
+        img = load_image(filename, width, invert, gamma)
+        imageio.imsave("test.jpg", img)
+
+        # Analyze the image
+        hog_fd = process(img)
+
+        # Map to ASCII
+        render(hog_fd, layers, filename + ".txt", indent, baud)
+
+    if profile:
+        with (contextlib.nullcontext(sys.stderr) if profile == "-" else io.open(profile, "w")) as f:
+            profiler.write(f, file=filename, width=width)
+    if profile_matcher:
+        profiler.dump_cprofile(profile_matcher)
 
 
 if __name__ == "__main__":
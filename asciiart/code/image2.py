@@ -30,17 +30,28 @@ correlation instead of min().
 Take care that empty image regions pick the "space" character!
 """
 
-# TODO: use some triple-strike characters for very dark printing
 # TODO: explore approaches to global optimization (be robust against deformation less than 1 character-size)
 
 import sys
-import json
 import os
+import time
 import numpy as np
 import imageio
 import io
+import contextlib
+import multiprocessing
 import click
+import atlas
+import matcher
+import charindex
+import hog
+import cache
+import encode
+import memory
+import instrument
 from skimage import feature, transform, color, exposure, util
+from scipy import ndimage as ndi
+from multiprocessing import shared_memory
 
 
 # The character itself (printed area) is 4x3 aspect ratio
@@ -56,91 +67,101 @@ ROUNDS = 2
 
 PREPARED_FILE = os.path.join(os.path.dirname(__file__), "chars_overstrike.json")
 
+# Single characters, for estimating the third layer of triple-strike
+SINGLES_FILE = os.path.join(os.path.dirname(__file__), "chars_ascii.json")
 
-# Load and pre-process an image file
-def load_image(filename, width, invert, gamma):
+
+# Load and pre-process an image file (filename, the file contents as bytes, or the decoded image),
+# at its original resolution.  Everything after this keeps the same dtype (float64, or float32 to save memory).
+def load_source(filename, invert, gamma, dtype=np.float64):
     # Read the image
-    img = imageio.imread(filename)
+    with instrument.stage("decode"):
+        img = filename if isinstance(filename, np.ndarray) else imageio.imread(filename)
+
+    with instrument.stage("grayscale"):
+        if img.shape[-1] == 4:
+            # Blend the alpha channel
+            img = color.rgba2rgb(img, background=(0, 0, 0))
 
-    if img.shape[-1] == 4:
-        # Blend the alpha channel
-        img = color.rgba2rgb(img, background=(0, 0, 0))
+        # Grayscale
+        img = color.rgb2gray(img).astype(dtype, copy=False)
 
-    # Grayscale
-    img = color.rgb2gray(img)
+        # Adjust the exposure
+        img = exposure.adjust_gamma(img, gamma)
 
-    # Adjust the exposure
-    img = exposure.adjust_gamma(img, gamma)
+        if invert:
+            img = util.invert(img)
+    return img
 
-    if invert:
-        img = util.invert(img)
 
+def output_shape(img, width):
     # Resample and adjust the aspect ratio
     width_px = (3 * width) * CELLPX
 
     img_width = 1.0 * width_px
     img_height = int(img.shape[0] * 3 * (img_width / (4 * img.shape[1])))
-    img = transform.resize(img, (img_height, img_width), anti_aliasing=True, mode='reflect')
+    return img_height, img_width
+
 
-    img = (img - img.min()) / (img.max() - img.min())
+# Load and pre-process an image file
+def load_image(filename, width, invert, gamma, dtype=np.float64):
+    img = load_source(filename, invert, gamma, dtype)
+    with instrument.stage("resize"):
+        img = transform.resize(img, output_shape(img, width), anti_aliasing=True, mode='reflect')
+
+    with instrument.stage("normalise"):
+        img = (img - img.min()) / (img.max() - img.min())
     return img
 
 
+def add_dots(image, cellsize=CELLPX):
+    # Put a dot in the middle of each cell, so that the HOG
+    # doesn't end up as exactly zero for areas with no gradient
+    # (four pixels per cell, each one a strided slice over all the cells)
+    mid = int(cellsize / 2)
+    for dy in (0, 1):
+        for dx in (0, 1):
+            image[mid + dy::cellsize, mid + dx::cellsize] += 0.001
+
+
 def process(image):
+    with instrument.stage("hog"):
+        return hog_image(image)
+
+
+def hog_image(image):
     (rows, cols) = image.shape
     cellsize = CELLPX
 
-    # Make sure the image is a multiple of 4x3 x cellsize in both dimensions
+    # Make sure the image is a multiple of 4x3 x cellsize in both dimensions (pad with blank)
     rn = cellsize * BROWS
     cn = cellsize * BCOLS
     newshape = (((rows + rn - 1) // rn) * rn, ((cols + cn - 1) // cn) * cn)
     if newshape != image.shape:
-        image = np.resize(image, newshape)
+        image = np.pad(image, ((0, newshape[0] - rows), (0, newshape[1] - cols)))
         (rows, cols) = image.shape
     n_cells_row = int(rows // cellsize)  # number of cells along row-axis
     n_cells_col = int(cols // cellsize)  # number of cells along col-axis
 
-    # Put a dot in the middle of each cell, so that the HOG
-    # doesn't end up as exactly zero for areas with no gradient
-    for iy in range(0, n_cells_row):
-        for ix in range(0, n_cells_col):
-            px = ix * cellsize
-            py = iy * cellsize
-            image[py + int(cellsize / 2), px + int(cellsize / 2)] += 0.001
-            image[py + int(cellsize / 2), px + int(cellsize / 2)+1] += 0.001
-            image[py + int(cellsize / 2)+1, px + int(cellsize / 2)] += 0.001
-            image[py + int(cellsize / 2)+1, px + int(cellsize / 2)+1] += 0.001
-
-    # HOG the whole image
-    fd, img = feature.hog(image,
-                          orientations=HOG_ORIENTATIONS,
-                          pixels_per_cell=(cellsize, cellsize),
-                          cells_per_block=(1, 1),
-                          block_norm='L1',  # ''L2-Hys',
-                          visualize=True,  # VISUALIZE,
-                          feature_vector=False)
-
-    # With 1x1 blocks we don't care about some of the fd dimensions
-    # Remove them for easier coding
-    fd = np.squeeze(fd)
-
-    # Normalize each histogram to the luminance of the block it derived from
-    for iy in range(0, n_cells_row):
-        for ix in range(0, n_cells_col):
-            px = ix * cellsize
-            py = iy * cellsize
-            cell = image[py: py + cellsize, px: px + cellsize]
-            luminance = cell.mean()
-            if VISUALIZE:
-                hog_cell = img[py: py + cellsize, px: px + cellsize]
-                hcm = hog_cell.mean()
-                hog_cell *= luminance / (hcm + sys.float_info.epsilon)
-
-            fd_cell = fd[iy, ix]
-            fdm = fd_cell.mean()
-            fd_cell *= luminance / (fdm + sys.float_info.epsilon)
+    add_dots(image, cellsize)
+
+    # HOG the whole image, with each histogram normalized to the luminance of the cell it derived from
+    fd = hog.hog(image, cellsize, HOG_ORIENTATIONS, block_norm='L1')  # ''L2-Hys'
 
     if VISUALIZE:
+        # Only skimage draws the image-of-HOG
+        _, img = feature.hog(image,
+                             orientations=HOG_ORIENTATIONS,
+                             pixels_per_cell=(cellsize, cellsize),
+                             cells_per_block=(1, 1),
+                             block_norm='L1',
+                             visualize=True,
+                             feature_vector=False)
+        # Normalize each cell of the picture to the luminance of the image cell
+        hog_cells = img.reshape(n_cells_row, cellsize, n_cells_col, cellsize)
+        luminance = hog.cell_means(image, (cellsize, cellsize))
+        hog_cells *= (luminance / (hog_cells.mean(axis=(1, 3)) + sys.float_info.epsilon))[:, None, :, None]
+
         # Normalize the image-of-HOG and save it just so we can see
         img *= 1 / img.max()
         imageio.imsave("hog.png", img)
@@ -148,90 +169,298 @@ def process(image):
     return fd
 
 
-def render(fd, outfile, chars1, chars2, indent=0, title=None):
-    # The fd is a histograms-of-gradients
-    n_cells_row = fd.shape[0]
-    n_cells_col = fd.shape[1]
-
-    # Load the previously-prepared histograms for the print characters.
-    # This is structured as a dictionary, indexed by character-pair, with each value being
-    # {
-    # "XY": [
-    #       [
-    #        [ ... 8 histogram values ...],
-    #       ]
-    #      ],
-    # }
-    with open(PREPARED_FILE, "rb") as data:
-        chars = json.load(data)
-
-    # Retain only the character combinations for chars1/chars2
-    if chars1:
-        chars1 = " " + chars1
-        chars = {k: v for k, v in chars.items() if k[0] in chars1}
-    if chars2:
-        chars2 = " " + chars2
-        chars = {k: v for k, v in chars.items() if k[1] in chars2}
-
-    # Make as numpy
-    for c in chars.keys():
-        chars[c] = np.array(chars[c])
-
-    charlums = {c: chars[c].mean() for c in chars.keys()}
-
-    result = []
-    # Look at each 3x5 block in the HOG and match it to the best 3x5 block in the chars.
-    # (There's probably some numpy way to do this all at once, which would improve perf)
-    for iy in range(0, n_cells_row, BROWS):
-        line1 = ''
-        line2 = ''
-        for ix in range(0, n_cells_col, BCOLS):
-            fd_cell = fd[iy: iy+BROWS, ix: ix+BCOLS]
-            mean = fd_cell.mean()
-
-            best = 1e10
-            char = '  '
-            for c in chars.keys():
-                if mean >= charlums[c]:
-                    # Correlation: L2 distance
-                    corr = np.linalg.norm(chars[c] - fd_cell)
-                    # print("{}: {} = {}: {}".format(c, chars[c].shape, fd_cell.shape, corr))
-                    if corr < best:
-                        best = corr
-                        char = c
-
-            line1 = line1 + char[0]
-            line2 = line2 + char[1]
-
-        if outfile != "-":
-            print(line1 + " " + line2)
-
-        # Don't forget to strip trailing spaces from each line, they just waste time!
-        result.append(((" " * indent) + line1).rstrip() + "\r" + ((" " * indent) + line2).rstrip())
-
-    # Write a text file with all the iterations
-    if outfile == "-":
-        outfile = 1
+def resample_rows(img, factors, top, bottom, cols):
+    """
+    Rows [top, bottom) of the resampled image, the same linear interpolation as transform.resize
+    (and bit-for-bit the same: the coordinates are calculated the same way as ndimage.zoom does).
+    :param img: the anti-aliased source image
+    :param factors: (rows, cols) source pixels per output pixel
+    """
+    coords = np.meshgrid((np.arange(top, bottom) + 0.5) * factors[0] - 0.5,
+                         (np.arange(cols) + 0.5) * factors[1] - 0.5, indexing='ij')
+    return ndi.map_coordinates(img, np.array(coords), order=1, mode='mirror')
+
+
+def stream_image(filename, width, invert, gamma, band_rows=1, dtype=np.float64):
+    """
+    Load, resample and HOG the image in horizontal bands, instead of all at once.
+
+    This does the same as load_image() followed by process(), but only holds one band of the resampled image
+    at a time.  The source is read and anti-aliased at its original size (as transform.resize does),
+    then each band is interpolated from that, with one cell of halo above and below so that the gradients
+    at the band edges are the same as for the whole image.
+    The resampled image's range (for normalizing) is found with a first pass over the bands.
+    :param band_rows: rows of character-blocks in each band
+    :return: generator of HOG fd, (band_rows * BROWS, cols, HOG_ORIENTATIONS) for each band
+    """
+    img = load_source(filename, invert, gamma, dtype)
+    (out_rows, out_cols) = output_shape(img, width)
+    out_cols = int(out_cols)
+    cellsize = CELLPX
+
+    # Anti-alias like transform.resize, and clip the result to the range of the source
+    factors = np.divide(img.shape, (out_rows, out_cols))
+    bounds = (img.min(), img.max())
+    with instrument.stage("resize"):
+        img = ndi.gaussian_filter(img, np.maximum(0, (factors - 1) / 2), mode='mirror')
 
+    # Pad to a multiple of 4x3 x cellsize, as in process()
+    rn = cellsize * BROWS
+    cn = cellsize * BCOLS
+    rows = ((out_rows + rn - 1) // rn) * rn
+    cols = ((out_cols + cn - 1) // cn) * cn
+    band = band_rows * rn
+
+    # The range of the resampled image, for normalizing
+    (low, high) = (np.inf, -np.inf)
+    with instrument.stage("normalise"):
+        for top in range(0, out_rows, band):
+            pixels = np.clip(resample_rows(img, factors, top, min(top + band, out_rows), out_cols), *bounds)
+            (low, high) = (min(low, pixels.min()), max(high, pixels.max()))
+
+    for top in range(0, rows, band):
+        bottom = min(top + band, rows)
+        halo_top = max(top - cellsize, 0)
+        halo_bottom = min(bottom + cellsize, rows)
+
+        # This band and its halo, normalized, and padded with blank
+        with instrument.stage("resize"):
+            image = np.zeros((halo_bottom - halo_top, cols), dtype=img.dtype)
+            n = min(halo_bottom, out_rows) - halo_top
+            if n > 0:
+                pixels = np.clip(resample_rows(img, factors, halo_top, halo_top + n, out_cols), *bounds)
+                image[:n, :out_cols] = (pixels - low) / (high - low)
+
+        # HOG the band, and keep just the cells inside the halo
+        with instrument.stage("hog"):
+            add_dots(image, cellsize)
+            fd = hog.hog(image, cellsize, HOG_ORIENTATIONS, block_norm='L1')
+        start = (top - halo_top) // cellsize
+        yield fd[start: start + (bottom - top) // cellsize]
+
+
+class Matcher(object):
+    """The prepared character data for a set of rendering options, and matching of image blocks to it"""
+
+    def __init__(self, chars1=None, chars2=None, search="brute", approximate=0.0, layers=ROUNDS, chars3=None, beam=8,
+                 tie_break=0.0, dtype=None):
+        # Load the previously-prepared histograms for the print characters.
+        # This is indexed by character-pair ("XY"), with a (BROWS, BCOLS, HOG_ORIENTATIONS) histogram-block for
+        # each, memory-mapped from the binary atlas if there is one, otherwise read from the JSON.
+        chars = atlas.load(PREPARED_FILE)
+
+        # Retain only the character combinations for chars1/chars2
+        if chars1:
+            chars1 = " " + chars1
+            chars = atlas.select(chars, [k[0] in chars1 for k in chars.keys])
+        if chars2:
+            chars2 = " " + chars2
+            chars = atlas.select(chars, [k[1] in chars2 for k in chars.keys])
+
+        # The histograms as numpy, (N, BROWS, BCOLS, HOG_ORIENTATIONS), optionally in the same dtype as the image
+        if dtype is not None:
+            chars = chars._replace(features=chars.features.astype(dtype, copy=False))
+        self.keys, self.features, self.charlums = chars.keys, chars.features, chars.luminances
+
+        # Optionally search with the nearest-neighbour index instead of comparing with every character
+        self.index = charindex.get(chars) if search == "index" else None
+        self.approximate = approximate
+        self.tie_break = tie_break
+
+        self.layers = layers
+        self.beam = beam
+        if layers > 2:
+            # Triple-strike: the third layer is chosen from the single characters (always including space)
+            singles = atlas.load(SINGLES_FILE)
+            chars3 = " " + (chars3 or "".join(singles.keys))
+            self.singles = atlas.select(singles, [k in chars3 for k in singles.keys])
+            if dtype is not None:
+                self.singles = self.singles._replace(features=self.singles.features.astype(dtype, copy=False))
+
+    def strikes(self, blocks):
+        """
+        :param blocks: image HOG blocks, (B, BROWS, BCOLS, HOG_ORIENTATIONS)
+        :return: the characters to strike for each block (one per layer)
+        """
+        with instrument.stage("match"):
+            if self.layers > 2:
+                best, third = matcher.best_triples(blocks, self.features, self.charlums, self.singles.features,
+                                                   beam=self.beam)
+                return [self.keys[i] + self.singles.keys[j] if i >= 0 else '   ' for (i, j) in zip(best, third)]
+            if self.index is None:
+                best = matcher.best_matches(blocks, self.features, self.charlums, tie=self.tie_break)
+            else:
+                best = self.index.best_matches(blocks, eps=self.approximate)
+            return [self.keys[i] if i >= 0 else '  ' for i in best]
+
+    def match(self, row):
+        """
+        :param row: one row of blocks of the image HOG, (block_cols, BROWS, BCOLS, HOG_ORIENTATIONS)
+        :return: the text of each layer
+        """
+        return layer_lines(self.strikes(row), self.layers)
+
+
+def layer_lines(strikes, layers):
+    """The text of each layer, for a row of strikes"""
+    return ["".join(char[layer] for char in strikes) for layer in range(layers)]
+
+
+# Each worker process has the image HOG (attached from shared memory) and a Matcher
+worker_state = {}
+
+
+def init_worker(name, shape, dtype, options):
+    shm = shared_memory.SharedMemory(name=name)
+    worker_state["shm"] = shm
+    worker_state["fd"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    worker_state["matcher"] = Matcher(**options)
+
+
+def match_rows(task):
+    """Match the rows of blocks [start, stop) of the shared image HOG, in a worker process"""
+    (start, stop) = task
+    rows = matcher.blocks(worker_state["fd"], BROWS, BCOLS)
+    return [worker_state["matcher"].match(row) for row in rows[start: stop]]
+
+
+def match_parallel(fd, options, workers):
+    """
+    Match the rows of blocks in a pool of worker processes.
+    The workers attach to the image HOG in shared memory, and memory-map the atlas themselves,
+    so the only things sent between the processes are the row numbers and the resulting text.
+    :param fd: the image HOG (rows, cols, HOG_ORIENTATIONS)
+    :param options: the Matcher options
+    :return: generator of the text of each layer, for each row of blocks, in order
+    """
+    n_rows = fd.shape[0] // BROWS
+    # A few tasks per worker, so that the rows come back steadily (and in order)
+    step = max(1, n_rows // (4 * workers))
+    tasks = [(start, min(start + step, n_rows)) for start in range(0, n_rows, step)]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, fd.nbytes))
+    try:
+        np.ndarray(fd.shape, dtype=fd.dtype, buffer=shm.buf)[...] = fd
+        with multiprocessing.Pool(workers, init_worker, (shm.name, fd.shape, fd.dtype, options)) as pool:
+            for lines in pool.imap(match_rows, tasks):
+                yield from lines
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def render_rows(fd, chars1, chars2, indent=0, search="brute", approximate=0.0,
+                layers=ROUNDS, chars3=None, beam=8, echo=False, workers=1, tie_break=0.0, dtype=None):
+    """
+    Match the image to characters, one row of blocks at a time.
+    :param fd: the image HOG (rows, cols, HOG_ORIENTATIONS), or an iterable of bands of it (from stream_image)
+    :param echo: print each row to stdout as well
+    :param workers: number of processes to match in (the fd must be a whole image, not bands)
+    :param tie_break: prefer the lightest character-pair within this fraction of the best match
+    :param dtype: match in this dtype (e.g. np.float32, if that's what the fd is), instead of the atlas's own
+    :return: generator of the text for each row, with its layers separated by CR (see encode.py)
+    """
+    options = dict(chars1=chars1, chars2=chars2, search=search, approximate=approximate,
+                   layers=layers, chars3=chars3, beam=beam, tie_break=tie_break, dtype=dtype)
+
+    started = time.time()
+    # Look at each 3x5 block in the HOG and match it to the best 3x5 block in the chars.
+    # Each row of blocks is matched in one go: distances to every character, masked by luminance.
+    if workers > 1:
+        if not isinstance(fd, np.ndarray):
+            raise ValueError("Matching with several workers needs the whole image HOG")
+        matched = match_parallel(fd, options, workers)
+    else:
+        if isinstance(fd, np.ndarray):
+            fd = [fd]
+        with instrument.stage("atlas"):
+            chars = Matcher(**options)
+        matched = (chars.match(row) for band in fd for row in matcher.blocks(band, BROWS, BCOLS))
+
+    for lines in matched:
+        if echo:
+            print(" ".join(lines))
+
+        # Don't print anything that doesn't need printing, it just wastes time!
+        yield encode.encode_row(lines, indent)
+
+    if layers > 2:
+        print("Triple-strike, beam {}: matched in {:.2f}s".format(beam, time.time() - started), file=sys.stderr)
+
+
+def write_rows(rows, f, title=None):
+    """
+    Write the text, one row at a time as they're produced.
+    :param rows: iterable of row text (from render_rows)
+    :param f: binary file to write to (flushed after each row)
+    :param title: bytes to print under the image
+    """
     if title is None:
         title = b"\r\n"
 
-    with io.open(outfile, "wb") as f:
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write("\r\n".join(result).encode("utf-8"))
-        f.write(b"\r\n")
+    with instrument.stage("write"):
+        f.write(b"\r\n" * 7)
+        f.flush()
+    for row in rows:
+        with instrument.stage("write"):
+            f.write(row.encode("utf-8"))
+            f.write(b"\r\n")
+            f.flush()
+    with instrument.stage("write"):
         f.write(title)
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
-        f.write(b"\r\n")
+        f.write(b"\r\n" * 5)
+
+
+def format_title(title, width, indent=0):
+    # title is a string
+    # center it, and make bytes
+    title = " " * int(indent + (width - len(title))/2) + title
+    return title.encode("utf-8")
+
+
+class Tee(object):
+    """Write to several files at once"""
+
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+
+def cache_key(render_cache, pixels, options):
+    """
+    The render cache key for an image.
+    :param render_cache: cache.RenderCache
+    :param pixels: the decoded image
+    :param options: dictionary of all the rendering options
+    """
+    checksums = [atlas.load(PREPARED_FILE).checksum]
+    if options.get("layers", ROUNDS) > 2:
+        checksums.append(atlas.load(SINGLES_FILE).checksum)
+    return render_cache.key(pixels, options, checksums)
+
+
+def render(fd, outfile, chars1, chars2, indent=0, title=None, search="brute", approximate=0.0,
+           layers=ROUNDS, chars3=None, beam=8, record=None, workers=1, tie_break=0.0, baud=encode.BAUD, dtype=None):
+    # The fd is a histograms-of-gradients, (rows, cols, HOG_ORIENTATIONS), or an iterable of bands of it.
+    # If there's a 'record' file, it gets a copy of everything written.
+    rows = render_rows(fd, chars1, chars2, indent, search, approximate, layers, chars3, beam,
+                       echo=(outfile != "-"), workers=workers, tie_break=tie_break, dtype=dtype)
+
+    # Write a text file with all the iterations, each row as soon as it's matched
+    if outfile == "-":
+        outfile = 1
+
+    with io.open(outfile, "wb") as f:
+        counter = encode.Counter(f if record is None else Tee(f, record))
+        write_rows(rows, counter, title)
+    print(encode.format_print_time(counter.count, baud), file=sys.stderr)
 
 
 @click.command()
@@ -243,26 +472,91 @@ def render(fd, outfile, chars1, chars2, indent=0, title=None):
 @click.option('--chars2', help='Characters to use in the second layer')
 @click.option('--title', help='Title text')
 @click.option('--output', help='Output filename (use "-" for stdout)')
+@click.option('--search', type=click.Choice(["brute", "index"]), default="brute",
+              help='Compare with every character, or use the nearest-neighbour index')
+@click.option('--approximate', default=0.0, help='Index search tolerance (0 = exact)')
+@click.option('--layers', type=click.IntRange(2, 3), default=ROUNDS, help='Layers of overstrike (3 for triple-strike)')
+@click.option('--chars3', help='Characters to use in the third layer')
+@click.option('--beam', type=click.IntRange(1), default=8,
+              help='Triple-strike: how many character-pairs to extend for each block')
+@click.option('--stream', is_flag=True, default=False,
+              help='Process the image in bands, and write each row as soon as it is ready')
+@click.option('--cache', 'cache_dir', help='Directory to cache the results in')
+@click.option('--cache-size', default=cache.MAX_SIZE // (1024 * 1024), help='Cache size limit (MB)')
+@click.option('--workers', type=click.IntRange(1), default=1, help='Number of processes for the matching')
+@click.option('--tie-break', default=0.0,
+              help='Prefer the lightest character-pair within this fraction of the best match (e.g. 0.02)')
+@click.option('--baud', default=encode.BAUD, help='Line speed, for the estimated print time')
+@click.option('--float32', is_flag=True, default=False, help='Process the image in single precision (half the memory)')
+@click.option('--report-memory', is_flag=True, default=False, help='Print the memory used by each stage')
+@click.option('--profile', help='Write the time spent in each stage to this file, as JSON lines ("-" for stderr)')
+@click.option('--profile-matcher', help='Write a cProfile dump of the matching to this file')
 @click.argument('filename')
-def main(filename, width, invert, gamma, indent, chars1, chars2, title, output):
-    # Aspect ratio is determined by the input image.
-    # Width is determined here.
-    img = load_image(filename, width, invert, gamma)
-    # imageio.imsave("test.jpg", img)
-
-    # Analyze the image
-    hog_fd = process(img)
-
-    if title:
-        # title is a string
-        # center it, and make bytes
-        title = " " * int(indent + (width - len(title))/2) + title
-        title = title.encode("utf-8")
-
-    # Map to ASCII
+def main(filename, width, invert, gamma, indent, chars1, chars2, title, output, search, approximate,
+         layers, chars3, beam, stream, cache_dir, cache_size, workers, tie_break, baud, float32, report_memory,
+         profile, profile_matcher):
+    if layers > 2 and (search != "brute" or approximate or tie_break):
+        raise click.UsageError("--layers 3 compares with every character, "
+                               "so it can't use --search index, --approximate or --tie-break")
+    if stream and workers > 1:
+        raise click.UsageError("--stream matches each band as it's ready, so it can't use --workers")
     if not output:
         output = filename + ".txt"
-    render(hog_fd, output, chars1, chars2, indent, title)
+
+    dtype = np.float32 if float32 else np.float64
+    report = memory.MemoryReport(report_memory)
+    profiler = instrument.Profiler(["match"] if profile_matcher else ()) if profile or profile_matcher else None
+    source = filename
+    record = None
+    if cache_dir:
+        # If we've rendered this before, just write the same text again
+        render_cache = cache.RenderCache(cache_dir, cache_size * 1024 * 1024)
+        source = imageio.imread(filename)
+        options = dict(width=width, invert=invert, gamma=gamma, indent=indent, chars1=chars1, chars2=chars2,
+                       title=title, search=search, approximate=approximate, layers=layers, chars3=chars3, beam=beam,
+                       tie_break=tie_break, float32=float32)
+        key = cache_key(render_cache, source, options)
+        text = render_cache.get(key)
+        if text is not None:
+            with io.open(1 if output == "-" else output, "wb") as f:
+                f.write(text)
+            print(encode.format_print_time(len(text), baud), file=sys.stderr)
+            return
+        record = io.BytesIO()
+
+    with instrument.profiling(profiler):
+        # Aspect ratio is determined by the input image.
+        # Width is determined here.
+        if stream:
+            # Analyze the image one band at a time, as the rows are rendered
+            hog_fd = stream_image(source, width, invert, gamma, dtype=dtype)
+        else:
+            with report.stage("load_image"):
+                img = load_image(source, width, invert, gamma, dtype)
+            # imageio.imsave("test.jpg", img)
+
+            # Analyze the image
+            with report.stage("process"):
+                hog_fd = process(img)
+                img = None
+
+        if title:
+            title = format_title(title, width, indent)
+
+        # Map to ASCII
+        with report.stage("stream" if stream else "render"):
+            render(hog_fd, output, chars1, chars2, indent, title, search, approximate, layers, chars3, beam, record,
+                   workers, tie_break, baud, dtype if float32 else None)
+    report.summary()
+
+    if profile:
+        with (contextlib.nullcontext(sys.stderr) if profile == "-" else io.open(profile, "w")) as f:
+            profiler.write(f, file=filename, width=width)
+    if profile_matcher:
+        profiler.dump_cprofile(profile_matcher)
+
+    if record is not None:
+        render_cache.put(key, record.getvalue())
 
 
 if __name__ == "__main__":
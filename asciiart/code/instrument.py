@@ -0,0 +1,108 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Where does the time go?  Per-stage timing for the renderers (their --profile option).
+
+The renderers mark their stages with
+    with instrument.stage("resize"):
+        ...
+which does nothing unless there's a Profiler active (in this thread).  The stages are
+decode, grayscale (and gamma), resize, normalise, hog, atlas, match and write.
+A stage can run many times (e.g. matching, once per row); the Profiler adds them up, and records
+- wall: elapsed time (seconds),
+- cpu: process CPU time (seconds, all threads, so it can be more than the wall time with BLAS threads),
+- blocks: the net number of memory blocks allocated by the Python allocator, and
+- calls: how many times the stage ran.
+Optionally, it also runs cProfile over the matching only, and dumps the stats for pstats or snakeviz.
+
+To use it from the library (e.g. to add up many renders in the daemon or in batch mode):
+    profiler = instrument.Profiler()
+    with instrument.profiling(profiler):
+        ... render ...
+    profiler.write(sys.stderr, file="picture.jpg")
+"""
+
+import sys
+import json
+import time
+import cProfile
+import threading
+import contextlib
+
+
+# The profiler for each thread
+local = threading.local()
+
+
+class Profiler(object):
+
+    def __init__(self, cprofile_stages=()):
+        """
+        :param cprofile_stages: names of the stages to run cProfile over (e.g. ["match"])
+        """
+        self.totals = {}
+        self.cprofile = cProfile.Profile() if cprofile_stages else None
+        self.cprofile_stages = set(cprofile_stages)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profile = self.cprofile if name in self.cprofile_stages else None
+        (wall, cpu, blocks) = (time.perf_counter(), time.process_time(), sys.getallocatedblocks())
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu, sys.getallocatedblocks() - blocks)
+
+    def add(self, name, wall, cpu, blocks, calls=1):
+        total = self.totals.setdefault(name, dict(wall=0.0, cpu=0.0, blocks=0, calls=0))
+        total["wall"] += wall
+        total["cpu"] += cpu
+        total["blocks"] += blocks
+        total["calls"] += calls
+
+    def merge(self, other):
+        """Add the totals from another profiler (e.g. of each render, for the daemon's running totals)"""
+        self.add_totals(other.totals)
+
+    def add_totals(self, totals):
+        """Add totals, as in Profiler.totals (e.g. from a worker process)"""
+        for (name, total) in totals.items():
+            self.add(name, **total)
+
+    def records(self, **context):
+        """:return: a dictionary for each stage, in the order they first ran, with the context (e.g. the file)"""
+        return [dict(context, stage=name, **total) for (name, total) in self.totals.items()]
+
+    def write(self, f, **context):
+        """Write the records as JSON lines"""
+        for record in self.records(**context):
+            f.write(json.dumps(record) + "\n")
+
+    def dump_cprofile(self, filename):
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(filename)
+
+
+def active():
+    """:return: the Profiler for this thread, or None"""
+    return getattr(local, "profiler", None)
+
+
+@contextlib.contextmanager
+def profiling(profiler):
+    """Make a Profiler active in this thread"""
+    previous = active()
+    local.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        local.profiler = previous
+
+
+def stage(name):
+    """Time a stage, if there's a Profiler active"""
+    profiler = active()
+    return contextlib.nullcontext() if profiler is None else profiler.stage(name)
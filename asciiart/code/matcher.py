@@ -0,0 +1,143 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Match image HOG blocks to printed characters, all at once with numpy.
+
+The image HOG has shape (rows, cols, orientations), one histogram per 16x16 cell.
+Each character covers a block of BROWS x BCOLS cells, and the prepared character data
+has one (BROWS, BCOLS, orientations) histogram-block per character (or character-pair).
+
+Instead of comparing every block with every character in Python, we stack
+- the characters into one (N, BROWS, BCOLS, orientations) array, and
+- a row of image blocks into one (B, BROWS, BCOLS, orientations) array,
+then compute the (B, N) distance matrix and take the argmin along each row.
+
+The luminance gate (don't choose a character that's darker than the block) is applied as a mask.
+"""
+
+import numpy as np
+
+
+# The character itself (printed area) is 4x3 aspect ratio
+BROWS = 4
+BCOLS = 3
+
+
+def blocks(fd, brows=BROWS, bcols=BCOLS):
+    """
+    View the image HOG as character-sized blocks.
+    :param fd: HOG array (rows, cols, orientations), rows and cols a multiple of the block size.
+    :return: (block_rows, block_cols, brows, bcols, orientations).
+             This is a view, so changes to the blocks also change the fd.
+    """
+    (n_cells_row, n_cells_col, orientations) = fd.shape
+    view = fd.reshape(n_cells_row // brows, brows, n_cells_col // bcols, bcols, orientations)
+    return view.swapaxes(1, 2)
+
+
+def stack_chars(chars):
+    """
+    Stack the prepared character histograms into arrays.
+    :param chars: dictionary of {character(s): histogram-block}
+    :return: (keys, features, luminances), where features is (N, brows, bcols, orientations)
+             and luminances is the mean of each character's histograms.
+    """
+    keys = list(chars.keys())
+    features = np.stack([np.asarray(chars[c], dtype=float) for c in keys])
+    luminances = np.array([features[i].mean() for i in range(len(keys))])
+    return keys, features, luminances
+
+
+def distances(blocks, features):
+    """
+    L2 distance between each image block and each character.
+    :param blocks: (B, brows, bcols, orientations)
+    :param features: (N, brows, bcols, orientations)
+    :return: (B, N)
+    """
+    b = blocks.reshape(len(blocks), -1)
+    f = features.reshape(len(features), -1)
+    # |b - f|^2 = |b|^2 - 2 b.f + |f|^2
+    d2 = np.einsum("ij,ij->i", b, b)[:, None] - 2 * (b @ f.T) + np.einsum("ij,ij->i", f, f)[None, :]
+    return np.sqrt(np.maximum(d2, 0))
+
+
+def best_matches(blocks, features, luminances, gate=1.0, allowed=None, tie=0.0):
+    """
+    Find the best-matching character for each block.
+
+    A character is a candidate for a block if the block's mean is at least
+    (gate * the character's luminance), i.e. the character doesn't add too much ink.
+    :param blocks: (B, brows, bcols, orientations)
+    :param features: (N, brows, bcols, orientations)
+    :param luminances: (N,)
+    :param gate: scale factor for the luminance gate
+    :param allowed: optional boolean mask of candidates, (N,) for all blocks or (B, N) per block
+    :param tie: choose the lightest character whose distance is within this fraction of the best
+    :return: (B,) index of the best character for each block, or -1 where there's no candidate.
+    """
+    means = blocks.reshape(len(blocks), -1).mean(axis=1)
+    mask = means[:, None] >= (luminances * gate)[None, :]
+    if allowed is not None:
+        mask &= allowed
+    dist = np.where(mask, distances(blocks, features), np.inf)
+    if tie > 0:
+        near = dist <= dist.min(axis=1, keepdims=True) * (1 + tie)
+        best = np.argmin(np.where(near & mask, luminances[None, :], np.inf), axis=1)
+    else:
+        best = np.argmin(dist, axis=1)
+    best[~mask.any(axis=1)] = -1
+    return best
+
+
+def overstrike(features, luminances, singles):
+    """
+    Estimate the histograms for overstriking a third character onto a character-pair.
+    We don't have a scan of the triple-strike combinations, so combine the pair with the single character:
+    the third strike adds its histogram, reduced by how much of the block is already inked by the pair.
+    (For the block means, this is the "screen" blend: 1 - (1 - pair) * (1 - single).)
+    :param features: (..., brows, bcols, orientations) character-pair histograms
+    :param luminances: (...) luminance of each character-pair
+    :param singles: (M, brows, bcols, orientations) single-character histograms
+    :return: (..., M, brows, bcols, orientations)
+    """
+    scale = (1 - luminances)[..., None, None, None, None]
+    return features[..., None, :, :, :] + scale * singles
+
+
+def best_triples(blocks, features, luminances, singles, beam=8):
+    """
+    Find the best triple-strike for each block, using a beam search.
+    The character-pairs are scored as usual (including the luminance gate),
+    and only the best 'beam' pairs for each block are extended with a third character.
+    :param blocks: (B, brows, bcols, orientations)
+    :param features: (N, brows, bcols, orientations) character-pair histograms
+    :param luminances: (N,)
+    :param singles: (M, brows, bcols, orientations) single-character histograms for the third layer
+    :param beam: how many pairs to extend for each block
+    :return: ((B,) index of the pair, (B,) index of the third character), or -1 where there's no candidate.
+    """
+    n_blocks = len(blocks)
+    means = blocks.reshape(n_blocks, -1).mean(axis=1)
+    rows = np.arange(n_blocks)
+
+    # Score all the pairs, and keep the best few for each block
+    dist = np.where(means[:, None] >= luminances[None, :], distances(blocks, features), np.inf)
+    beam = min(beam, len(features))
+    top = np.argpartition(dist, beam - 1, axis=1)[:, :beam]
+    top_valid = np.isfinite(dist[rows[:, None], top])
+
+    # Extend each of them with every third character
+    estimate = overstrike(features[top], luminances[top], singles)
+    estimate_lum = estimate.reshape(estimate.shape[:3] + (-1,)).mean(axis=-1)
+    diff = (estimate - blocks[:, None, None]).reshape(estimate.shape[:3] + (-1,))
+    dist3 = np.sqrt(np.einsum("ijkl,ijkl->ijk", diff, diff))
+    mask = top_valid[:, :, None] & (means[:, None, None] >= estimate_lum)
+    dist3 = np.where(mask, dist3, np.inf).reshape(n_blocks, -1)
+
+    best = np.argmin(dist3, axis=1)
+    pair = top[rows, best // len(singles)]
+    single = best % len(singles)
+    none = ~mask.reshape(n_blocks, -1).any(axis=1)
+    pair[none] = -1
+    single[none] = -1
+    return pair, single
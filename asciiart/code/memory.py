@@ -0,0 +1,55 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Memory accounting for the renderers and the prep scripts (their --report-memory option).
+
+For each stage this prints, to stderr,
+- the peak of the memory traced while the stage ran (numpy reports its arrays to tracemalloc,
+  so this includes the temporary arrays), and what's still held afterwards, and
+- the largest allocations that the stage left behind, by source line;
+and at the end, the peak RSS of the whole process.
+Tracing slows things down a little, so it's only switched on when asked for.
+"""
+
+import sys
+import resource
+import contextlib
+import tracemalloc
+
+
+MB = 1024 * 1024
+
+
+class MemoryReport(object):
+
+    def __init__(self, enabled=True, top=3):
+        """
+        :param enabled: False to do nothing at all
+        :param top: how many of the largest allocations to show for each stage
+        """
+        self.enabled = enabled
+        self.top = top
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        yield
+        (current, peak) = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+
+        largest = [stat for stat in after.compare_to(before, "lineno") if stat.size_diff > 0][:self.top]
+        print("{}: peak {:.1f}MB, holding {:.1f}MB; largest: {}".format(
+            name, peak / MB, current / MB,
+            ", ".join("{}:{} {:.1f}MB".format(stat.traceback[0].filename.split("/")[-1], stat.traceback[0].lineno,
+                                              stat.size_diff / MB) for stat in largest) or "-"), file=sys.stderr)
+
+    def summary(self):
+        if self.enabled:
+            # ru_maxrss is in kilobytes on Linux
+            print("Peak RSS {:.1f}MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+                  file=sys.stderr)
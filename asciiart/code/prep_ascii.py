@@ -12,12 +12,15 @@ Writes them all to a JSON file that can be used for rendering later.
 
 """
 
-import sys
 import json
 import numpy as np
 import imageio
 import io
 import click
+import atlas
+import hog
+import stages
+import memory
 from skimage import feature, exposure, transform
 
 
@@ -35,33 +38,34 @@ CHARS_TOPMARGIN =   SCALE * 306
 CHARS_ROWHEIGHT =   SCALE * 100
 CHARS_CHARWIDTH =   SCALE * 60
 
-loaded_files = {}
-
 # Which character from the 5 available?
 INDEX = 2
 
+# The characters in the table
+CHARS = [chr(c) for c in range(ord(' '), ord('_') + 1)]
+
+# Where the cache of build stages is kept (see stages.py)
+CACHE_DIR = stages.CACHE_DIR
+
 
-# Load and cache an image file, normalized as float, inverted
-def load_image(filename):
-    if filename in loaded_files:
-        return loaded_files[filename]
-    img = imageio.imread(filename, as_gray=True).astype(np.float)
+# Load an image file, normalized as float, inverted
+def load_image(filename, k=10, dtype="float64"):
+    img = imageio.imread(filename, as_gray=True).astype(dtype)
 
     # Normalize the whole image
     # img *= 1.0/(img.max() - img.min())
     img = (img - np.min(img))/np.ptp(img)
 
     # Normalize on a sigmoid curve to better separate ink from paper
-    k = 10
     img = np.sqrt(1 / (1 + np.exp(k * (img - 0.5))))
 
-    loaded_files[filename] = img
     return img
 
 
 # Pull out the image of a single character.
 # Each character has multiple images, specify index (0-5) to choose one
-def chars_image(c, index=0, count=1):
+def chars_image(full_image, c, index=0, count=1, left=CHARS_LEFTMARGIN, columnwidth=CHARS_COLUMNWIDTH,
+                top=CHARS_TOPMARGIN, rowheight=CHARS_ROWHEIGHT, charwidth=CHARS_CHARWIDTH):
     oc = ord(c)
     if oc < ord(' '):
         return None
@@ -71,13 +75,10 @@ def chars_image(c, index=0, count=1):
     row = (oc - ord(' ')) % 16
     column = int((oc - ord(' ')) / 16)
 
-    pixX = CHARS_LEFTMARGIN + (CHARS_COLUMNWIDTH * column) + (index * CHARS_CHARWIDTH)
-    pixY = CHARS_TOPMARGIN + (CHARS_ROWHEIGHT * row)
+    pixX = left + (columnwidth * column) + (index * charwidth)
+    pixY = top + (rowheight * row)
 
-    # Get the full original image
-    full_image = load_image("chars_ascii.jpg")
-
-    char = full_image[pixY: pixY + CHARS_ROWHEIGHT, pixX: pixX + count * CHARS_CHARWIDTH]
+    char = full_image[pixY: pixY + rowheight, pixX: pixX + count * charwidth]
 
     # invert so ink>paper
     # char = 1 - char
@@ -85,85 +86,55 @@ def chars_image(c, index=0, count=1):
     return char
 
 
-# Calculate the average luminance for a character
-def luminance(image):
-    return np.mean(image)
-
-
-# Calculate the HOG for a character (as a single histogram)
-def hog_char(image, count, luminance):
-    rows = image.shape[0]
-    cols = image.shape[1]
-    rows_cellsize = int(image.shape[0]/BROWS)
-    cols_cellsize = int(image.shape[1]/BCOLS)
-    fd, img = feature.hog(image,
-                          orientations=8,
-                          pixels_per_cell=(rows_cellsize, cols_cellsize),  # (16, 16),
-                          cells_per_block=(1, 1),
-                          block_norm='L2-Hys',
-                          visualize=True,
-                          feature_vector=False)
-
-    # With 1x1 blocks we don't care about some of the fd dimensions
-    # Remove them for easier coding
-    fd = np.squeeze(fd)
+# Stage: crop all the characters from the scan, (len(CHARS), rows, cols)
+def table_cells(full_image, index=INDEX, **geometry):
+    return np.stack([chars_image(full_image, c, index=index, **geometry) for c in CHARS])
 
-    # Normalize each histogram to the luminance of the block it derived from
-    n_cells_row = int(rows // rows_cellsize)  # number of cells along row-axis
-    n_cells_col = int(cols // cols_cellsize)  # number of cells along col-axis
 
-    for iy in range(0, n_cells_row):
-        for ix in range(0, n_cells_col):
-            px = ix * cols_cellsize
-            py = iy * rows_cellsize
-            # cell = image[py: py + rows_cellsize, px: px + cols_cellsize]
-            # luminance = cell.mean()
-
-            hog_cell = img[py: py + rows_cellsize, px: px + cols_cellsize]
-            hog_cell *= luminance / (hog_cell.mean() + sys.float_info.epsilon)
-
-            fd_cell = fd[iy, ix]
-            fd_cell *= luminance / (fd_cell.mean() + sys.float_info.epsilon)
-
-    return (fd, img)
-
-
-def analyze_table_image():
-    # (Later: run this over all 5 of the char instances)
-
-    luminances = {}
-
-    # Find the minimum bounding-box for each character
+# Stage: the minimum bounding-box for each character, (rowbounds, colbounds)
+def table_bounds(cells, threshold=0.4):
     rowbounds = [1e10, 0]
     colbounds = [1e10, 0]
-    for i in range(ord(' '), ord('_')+1):
-        c = chr(i)
-        img = chars_image(c, index=INDEX)
-        luminances[c] = img.mean()
+    for (c, img) in zip(CHARS, cells):
         if c != ' ':
-            edges = np.unravel_index(np.argmax(img > 0.4, axis=None), img.shape)
+            edges = np.unravel_index(np.argmax(img > threshold, axis=None), img.shape)
             if edges[0] < rowbounds[0]:
                 rowbounds[0] = edges[0]
             if edges[1] < colbounds[0]:
                 colbounds[0] = edges[1]
             flp = np.flip(img)
-            edges = np.unravel_index(np.argmax(flp > 0.4, axis=None), img.shape)
+            edges = np.unravel_index(np.argmax(flp > threshold, axis=None), img.shape)
             if img.shape[0] - edges[0] > rowbounds[1]:
                 rowbounds[1] = img.shape[0] - edges[0]
             if img.shape[1] - edges[1] > colbounds[1]:
                 colbounds[1] = img.shape[1] - edges[1]
             edges = None
+    return rowbounds, colbounds
+
+
+# Calculate the average luminance for a character
+def luminance(image):
+    return np.mean(image)
+
+
+# Stage: the luminance of each character, {c: luminance}
+def table_luminances(cells):
+    return {c: luminance(img) for (c, img) in zip(CHARS, cells)}
+
+
+# Stage: normalize all the luminances.
+# We want to reduce the difference between the smallest (lightest printable character, e.g. apostrophe) and space,
+# otherwise the resulting image gets too much whitespace.  So the minimum and slope take this into account.
+def normalize_luminances(luminances, fudg=0.05):
+    # fudg is where we want the lightest-printable to be
+    luminances = dict(luminances)
 
     # characters sorted by increasing luminance
     sl = sorted(luminances, key=luminances.get)
 
-    # Normalize all the luminances.
-    # We want to reduce the difference between the smallest (lightest printable character, e.g. apostrophe) and space,
-    # otherwise the resulting image gets too much whitespace.  So the minimum and slope take this into account.
     minl = luminances[sl[0]]    # zero-point (space)
     manl = luminances[sl[1]]    # lightest-printable
     maxl = luminances[sl[-1]]   # darkest
-    fudg = 0.05                 # where we want the lightest-printable to be
     for c in sl:
         if luminances[c] == minl:
             luminances[c] = 0
@@ -171,46 +142,78 @@ def analyze_table_image():
             # manl => fudg
             # maxl => 1.0
             luminances[c] = fudg + ((luminances[c] - manl)*(1.0 - fudg) / (maxl - manl))
+    return luminances
 
-    for c in sl:
-        print("\"{}\", {}".format(c, luminances[c]))
 
-    bylum = "".join(sl)
-    print(bylum)
+# Calculate the HOG for a character (as a single histogram), not yet scaled to its luminance
+def hog_char(image, brows=BROWS, bcols=BCOLS, block_norm='L2-Hys'):
+    rows_cellsize = int(image.shape[0]/brows)
+    cols_cellsize = int(image.shape[1]/bcols)
+    fd = feature.hog(image,
+                     orientations=8,
+                     pixels_per_cell=(rows_cellsize, cols_cellsize),  # (16, 16),
+                     cells_per_block=(1, 1),
+                     block_norm=block_norm,
+                     feature_vector=False)
+
+    # With 1x1 blocks we don't care about some of the fd dimensions
+    # Remove them for easier coding
+    return np.squeeze(fd)
+
+
+# Stage: the HOG for each character, {c: fd}
+def table_hogs(cells, bounds, **params):
+    (rowbounds, colbounds) = bounds
+    return {c: hog_char(img[rowbounds[0]: rowbounds[1], colbounds[0]: colbounds[1]], **params)
+            for (c, img) in zip(CHARS, cells)}
 
-    # calculate the HOG for each character
+
+# Stage: normalize each histogram to the luminance of the character, {c: list}
+def table_features(hogs, luminances):
     fds = {}
-    chars = []
-    images = []
-    for i in range(ord(' '), ord('_')+1):
-        c = chr(i)
+    for (c, fd) in hogs.items():
+        fds[c] = hog.scale_to_luminance(fd.copy(), luminances[c]).tolist()
+    return fds
 
-        img = chars_image(c, index=INDEX)
-        char = img[rowbounds[0]: rowbounds[1], colbounds[0]: colbounds[1]]
-        chars.append(char)
-        (fd, image) = hog_char(char, 1, luminances[c])
 
-        fds[c] = fd.tolist()
-        images.append(image)
+def analyze_table_image(float16=False, cache_dir=CACHE_DIR, float32=False, report_memory=False):
+    # (Later: run this over all 5 of the char instances)
 
-    # Save a combined image of HOGs
-#    im = np.concatenate(tuple(images))
-#    im *= 1 / im.max()
-#    imageio.imsave("ascii.jpg", im)
+    # Each stage is cached, and only recomputed when its parameters, its code (the function and what it
+    # depends on), or an earlier stage change
+    report = memory.MemoryReport(report_memory)
+    build = stages.Build(cache_dir, enabled=cache_dir is not None, report=report)
+    source = build.source("chars_ascii.jpg")
+    scan = build.stage("ascii_scan", load_image, [source], k=10, dtype="float32" if float32 else "float64")
+    cells = build.stage("ascii_cells", table_cells, [scan], depends=[chars_image, CHARS], index=INDEX,
+                        left=CHARS_LEFTMARGIN, columnwidth=CHARS_COLUMNWIDTH, top=CHARS_TOPMARGIN,
+                        rowheight=CHARS_ROWHEIGHT, charwidth=CHARS_CHARWIDTH)
+    bounds = build.stage("ascii_bounds", table_bounds, [cells], depends=[CHARS], threshold=0.4)
+    rawlums = build.stage("ascii_luminances", table_luminances, [cells], depends=[luminance, CHARS])
+    luminances = build.stage("ascii_levels", normalize_luminances, [rawlums], fudg=0.05)
+    hogs = build.stage("ascii_hog", table_hogs, [cells, bounds], depends=[hog_char, CHARS],
+                       brows=BROWS, bcols=BCOLS, block_norm='L2-Hys')
+    features = build.stage("ascii_features", table_features, [hogs, luminances],
+                           depends=[hog.scale_to_luminance])
 
-    # Save a conbined image of characters
-#    im = np.concatenate(tuple(chars))
-#    im *= 1 / im.max()
-#    imageio.imsave("ascii1.jpg", im)
+    # characters sorted by increasing luminance
+    sl = sorted(rawlums.value, key=rawlums.value.get)
+    for c in sl:
+        print("\"{}\", {}".format(c, luminances.value[c]))
 
-#    im = np.concatenate(tuple(chars), axis=1)
-#    im *= 1 / im.max()
-#    imageio.imsave("ascii2.jpg", im)
+    bylum = "".join(sl)
+    print(bylum)
+
+    fds = features.value
 
     # Save the JSON
     with io.open("chars_ascii.json", "w") as afile:
         json.dump(fds, afile, indent=2)
 
+    # Save the binary atlas, which the renderers memory-map instead of parsing the JSON
+    atlas.write("chars_ascii.atlas", fds, dtype=np.float16 if float16 else np.float32)
+    report.summary()
+
 
 def print_table():
     # Print the ASCII characters table.
@@ -234,11 +237,16 @@ def print_table():
 
 @click.command()
 @click.option('--table', is_flag=True, default=False, help='Print the character table')
-def main(table):
+@click.option('--float16', is_flag=True, default=False, help='Store the binary atlas as float16')
+@click.option('--cache', 'cache_dir', default=CACHE_DIR, help='Directory for the cached build stages')
+@click.option('--no-cache', is_flag=True, default=False, help='Recompute everything, and don\'t cache it')
+@click.option('--float32', is_flag=True, default=False, help='Process the scan in single precision (half the memory)')
+@click.option('--report-memory', is_flag=True, default=False, help='Print the memory used by each stage')
+def main(table, float16, cache_dir, no_cache, float32, report_memory):
     if table:
         print_table()
     else:
-        analyze_table_image()
+        analyze_table_image(float16, None if no_cache else cache_dir, float32, report_memory)
 
 
 if __name__ == "__main__":
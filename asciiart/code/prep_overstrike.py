@@ -12,12 +12,16 @@ Writes them all to a JSON file that can be used for rendering later.
 
 """
 
-import sys
 import json
 import numpy as np
 import imageio
 import io
+import multiprocessing
 import click
+import atlas
+import hog
+import stages
+import memory
 from skimage import feature, transform
 
 
@@ -41,17 +45,19 @@ CHARS_CHARWIDTH =   SCALE * 60.0
 STARTCHAR = 0x20
 ENDCHAR = 0x5f
 
-loaded_files = {}
+# The characters, in the order of the rows and columns of the table
+CHARS = [chr(c) for c in range(STARTCHAR, ENDCHAR + 1)]
 
+# Where the cache of build stages is kept (see stages.py)
+CACHE_DIR = stages.CACHE_DIR
 
-# Load and cache an image file, normalized as float, inverted
-def load_image(filename):
-    if filename in loaded_files:
-        return loaded_files[filename]
-    img = imageio.imread(filename, as_gray=True).astype(np.float)
+
+# Load an image file, normalized as float, inverted
+def load_image(filename, rotation=ROTATION, shear=SHEAR, translation=TRANSLATION, k=10, dtype="float64"):
+    img = imageio.imread(filename, as_gray=True).astype(dtype)
 
     # Warp it to be reasonably squared
-    tf = transform.AffineTransform(rotation=ROTATION, shear=SHEAR, translation=TRANSLATION)
+    tf = transform.AffineTransform(rotation=rotation, shear=shear, translation=translation)
     img = transform.warp(img, inverse_map=tf)
 
     # Normalize the whole image
@@ -59,75 +65,69 @@ def load_image(filename):
     img = (img - np.min(img))/np.ptp(img)
 
     # Normalize on a sigmoid curve to better separate ink from paper
-    k = 10
     img = np.sqrt(1 / (1 + np.exp(k * (img - 0.5))))
 
     # imageio.imsave("chars_overstrike_rot.png", img)
-    loaded_files[filename] = img
     return img
 
 
-# Pull out the image of a character-pair, c1 overstruck with c2.
-# The character at (x, y) should be the same as the character at (y, x) but due to printing may be slightly
-# different.  We just analyze them all anyway, and it'll sort out in the final mapping.
-# (Could double the performance by folding in half, but we don't care really)
-def one_chars_image(c1, c2):
-    cc = c1 + c2
-    oc1 = ord(c1)
-    if oc1 < ord(' '):
-        raise ValueError("Character? " + c1)
-    if oc1 > ord('_'):
-        raise ValueError("Character? " + c1)
-    oc2 = ord(c2)
-    if oc2 < ord(' '):
-        raise ValueError("Character? " + c2)
-    if oc2 > ord('_'):
-        raise ValueError("Character? " + c2)
-
-    # The character at (col, row)
-    col = (oc2 - ord(' '))
-    row = (oc1 - ord(' '))
-
-    pixX = int(CHARS_LEFTMARGIN + (CHARS_CHARWIDTH * col))
-    pixY = int(CHARS_TOPMARGIN + (CHARS_ROWHEIGHT * row))
-
-    # Get the full original image
-    full_image = load_image("chars_overstrike.jpg")
-
-    # Pull out the character from its (x,y) position
-    img = full_image[pixY: pixY + int(CHARS_ROWHEIGHT), pixX: pixX + int(CHARS_CHARWIDTH)]
-
-    # invert so ink>paper
-    # char = 1 - char
-
-    # Find the bounding-box of the printed character.
-    # (Many are way off center, e.g. comma and apostrophe)
-    edges1 = (0, 0)
-    edges2 = (int(CHARS_ROWHEIGHT), int(CHARS_CHARWIDTH))
-    if cc != '  ':
-        # Top and left bounds
-        edges1 = np.unravel_index(np.argmax(img > 0.4, axis=None), img.shape)
-        # Bottom and right bounds
-        flp = np.flip(img)
-        edges2 = np.unravel_index(np.argmax(flp > 0.4, axis=None), img.shape)
-        # edges2 = (img.shape[0] - edges[0], img.shape[1] - edges[1])
-
-    # Save some cropped images.  Each should ideally be just a single character-cell.
-#    if c1 in " #$01JKXY^_" and c2 in " !@123AJKZ[]_":
-#        imageio.imsave("char_{:x}_{:x}.jpg".format(oc2, oc1), char)
-
-    return img, edges1, edges2
-
-
-def chars_image(c1, c2):
-    img, edges1a, edges2a = one_chars_image(c1, c2)
-    _, edges1b, edges2b = one_chars_image(c2, c1)
-    topdiff = edges1b[0] - edges1a[0]
-    leftdiff = 0  # edges1b[1] - edges1a[1]
-    img = np.roll(img, int(topdiff/2), axis=0)
-    # img = np.roll(img, -int(leftdiff/2), axis=1)
-    return img, (edges1a[0] + int(topdiff/2), edges1a[1] + int(leftdiff/2)), (edges2a[0] + int(topdiff/2), edges2a[1] + int(leftdiff/2))
-    # return img, (edges1a[0], edges1a[1]), (edges2a[0], edges2a[1])
+# Pull out the image of every character-pair at once, (len(CHARS), len(CHARS), rows, cols).
+# The cell at [i, j] is CHARS[i] overstruck with CHARS[j].
+# Each cell can be rolled vertically by a different amount (as np.roll(cell, shift, axis=0)).
+def crop_cells(full_image, shifts=None, left=CHARS_LEFTMARGIN, top=CHARS_TOPMARGIN,
+               rowheight=CHARS_ROWHEIGHT, charwidth=CHARS_CHARWIDTH):
+    n = len(CHARS)
+    tops = np.array([int(top + (rowheight * row)) for row in range(n)])
+    lefts = np.array([int(left + (charwidth * col)) for col in range(n)])
+    cell_rows = int(rowheight)
+    cell_cols = int(charwidth)
+
+    y = np.arange(cell_rows)
+    if shifts is None:
+        rows = tops[:, None, None] + y[None, None, :]
+    else:
+        rows = tops[:, None, None] + (y[None, None, :] - shifts[:, :, None]) % cell_rows
+    cols = lefts[:, None] + np.arange(cell_cols)[None, :]
+    return full_image[rows[:, :, :, None], cols[None, :, None, :]]
+
+
+# Find the bounding-box of the printed character in every cell.
+# (Many are way off center, e.g. comma and apostrophe)
+# Returns ((top, left), (bottom, right)) where each is (n, n): the first inked pixel in raster order,
+# and the same from the bottom-right of the cell.
+def ink_edges(cells, threshold=0.4):
+    n = cells.shape[:2]
+    ink = (cells > threshold).reshape(n + (-1,))
+    top, left = np.unravel_index(ink.argmax(axis=-1), cells.shape[2:])
+    ink = (cells[:, :, ::-1, ::-1] > threshold).reshape(n + (-1,))
+    bottom, right = np.unravel_index(ink.argmax(axis=-1), cells.shape[2:])
+
+    # Space-space is blank, use the whole cell
+    top[0, 0], left[0, 0] = 0, 0
+    bottom[0, 0], right[0, 0] = cells.shape[2:]
+    return (top, left), (bottom, right)
+
+
+# Stage: crop all the cells from the scan, lined up with their transpose.
+# The character-pair at (x, y) should be the same as the one at (y, x), but due to printing may be slightly
+# different.  Line them up: move each one vertically, halfway to where its transpose was printed.
+# Returns (cells, ((top, left), (bottom, right))) with the ink edges of each cell.
+def table_cells(full_image, threshold=0.4, **geometry):
+    (top, left), (bottom, right) = ink_edges(crop_cells(full_image, **geometry), threshold)
+    shifts = ((top.T - top) / 2).astype(int)
+    cells = crop_cells(full_image, shifts, **geometry)
+    return cells, ((top + shifts, left), (bottom + shifts, right))
+
+
+# Stage: the largest bounding-box of any character (except space), (rowbounds, colbounds)
+def table_bounds(cells):
+    (cells, ((top, left), (bottom, right))) = cells
+    (n, _, cell_rows, cell_cols) = cells.shape
+    printed = np.ones((n, n), dtype=bool)
+    printed[0, 0] = False
+    rowbounds = [int(top[printed].min()), int((cell_rows - bottom[printed]).max())]
+    colbounds = [int(left[printed].min()), int((cell_cols - right[printed]).max())]
+    return rowbounds, colbounds
 
 
 # Calculate the average luminance for a character
@@ -135,84 +135,29 @@ def luminance(image):
     return np.mean(image)
 
 
-# Calculate the HOG for a character-pair (as a single histogram)
-def hog_char(image, luminance):
-    rows = image.shape[0]
-    cols = image.shape[1]
-    rows_cellsize = int(image.shape[0]/BROWS)
-    cols_cellsize = int(image.shape[1]/BCOLS)
-    fd, img = feature.hog(image,
-                          orientations=8,
-                          pixels_per_cell=(rows_cellsize, cols_cellsize),  # (16, 16),
-                          cells_per_block=(1, 1),
-                          block_norm='L1',
-                          visualize=True,
-                          feature_vector=False)
-
-    # With 1x1 blocks we don't care about some of the fd dimensions
-    # Remove them for easier coding
-    fd = np.squeeze(fd)
-
-    # Normalize each histogram to the luminance of the block it derived from
-    n_cells_row = int(rows // rows_cellsize)  # number of cells along row-axis
-    n_cells_col = int(cols // cols_cellsize)  # number of cells along col-axis
-
-    for iy in range(0, n_cells_row):
-        for ix in range(0, n_cells_col):
-            px = ix * cols_cellsize
-            py = iy * rows_cellsize
-            # cell = image[py: py + rows_cellsize, px: px + cols_cellsize]
-            # luminance = cell.mean()
-
-            hog_cell = img[py: py + rows_cellsize, px: px + cols_cellsize]
-            hog_cell *= luminance / (hog_cell.mean() + sys.float_info.epsilon)
-
-            fd_cell = fd[iy, ix]
-            fd_cell *= luminance / (fd_cell.mean() + sys.float_info.epsilon)
-
-    return (fd, img)
-
-
-def analyze_table_image():
+# Stage: the luminance of each character-pair, {pair: luminance}
+def table_luminances(cells):
+    (cells, _) = cells
     luminances = {}
+    for i in range(len(CHARS)):
+        for j in range(len(CHARS)):
+            luminances[CHARS[i] + CHARS[j]] = luminance(cells[i, j])
+    return luminances
+
 
-    # Find the minimum bounding-box for each character-pair
-
-    # rowbounds/colbounds will be the largest box of any character
-    rowbounds = [1e10, 0]
-    colbounds = [1e10, 0]
-
-    for i in range(STARTCHAR, ENDCHAR+1):
-        for j in range(STARTCHAR, ENDCHAR+1):
-            c1 = chr(i)
-            c2 = chr(j)
-            cc = c1 + c2
-            # Pull out the character-pair from the whole image
-            img, edges1, edges2 = chars_image(c1, c2)
-            luminances[cc] = img.mean()
-
-            # Find the bounding-box of the printed character.
-            # (Many are way off center, e.g. comma and apostrophe)
-            if cc != '  ':
-                if edges1[0] < rowbounds[0]:
-                    rowbounds[0] = edges1[0]
-                if edges1[1] < colbounds[0]:
-                    colbounds[0] = edges1[1]
-                if img.shape[0] - edges2[0] > rowbounds[1]:
-                    rowbounds[1] = img.shape[0] - edges2[0]
-                if img.shape[1] - edges2[1] > colbounds[1]:
-                    colbounds[1] = img.shape[1] - edges2[1]
+# Stage: normalize all the luminances.
+# We want to reduce the difference between the smallest (lightest printable character, e.g. apostrophe) and space,
+# otherwise the resulting image gets too much whitespace.  So the minimum and slope take this into account.
+def normalize_luminances(luminances, fudg=0.05):
+    # fudg is where we want the lightest-printable to be
+    luminances = dict(luminances)
 
     # characters sorted by increasing luminance
     sl = sorted(luminances, key=luminances.get)
 
-    # Normalize all the luminances.
-    # We want to reduce the difference between the smallest (lightest printable character, e.g. apostrophe) and space,
-    # otherwise the resulting image gets too much whitespace.  So the minimum and slope take this into account.
     minl = luminances[sl[0]]    # zero-point (space)
     manl = luminances[sl[1]]    # lightest-printable
     maxl = luminances[sl[-1]]   # darkest
-    fudg = 0.05                 # where we want the lightest-printable to be
     for c in sl:
         if luminances[c] == minl:
             luminances[c] = 0
@@ -220,53 +165,99 @@ def analyze_table_image():
             # manl => fudg
             # maxl => 1.0
             luminances[c] = fudg + ((luminances[c] - manl)*(1.0 - fudg) / (maxl - manl))
+    return luminances
 
-    for c in sl:
-        print("\"{}\", {}".format(c, luminances[c]))
 
-    bylum = "".join(sl)
-    print(bylum)
+# Calculate the HOG for a character-pair (as a single histogram), not yet scaled to its luminance
+def hog_char(image, brows=BROWS, bcols=BCOLS, block_norm='L1'):
+    rows_cellsize = int(image.shape[0]/brows)
+    cols_cellsize = int(image.shape[1]/bcols)
+    fd = feature.hog(image,
+                     orientations=8,
+                     pixels_per_cell=(rows_cellsize, cols_cellsize),  # (16, 16),
+                     cells_per_block=(1, 1),
+                     block_norm=block_norm,
+                     feature_vector=False)
 
-    # calculate the HOG for each character-pair
+    # With 1x1 blocks we don't care about some of the fd dimensions
+    # Remove them for easier coding
+    return np.squeeze(fd)
+
+
+# HOG for a batch of character-pairs, ([image, ...], hog_char parameters) (one task for the process pool)
+def hog_chars(task):
+    (images, params) = task
+    return [hog_char(image, **params) for image in images]
+
+
+# Stage: the HOG for each character-pair, {pair: fd}, a row of the table at a time in each worker process.
+# With 'fold', only analyze the pairs on and above the diagonal, and use the same HOG for (c2, c1) as (c1, c2).
+def table_hogs(cells, bounds, fold=False, workers=None, **params):
+    (cells, _) = cells
+    (rowbounds, colbounds) = bounds
+    n = len(CHARS)
+    chars = cells[:, :, rowbounds[0]: rowbounds[1], colbounds[0]: colbounds[1]]
+    columns = [range(i if fold else 0, n) for i in range(n)]
+    tasks = [([chars[i, j] for j in columns[i]], params) for i in range(n)]
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(hog_chars, tasks)
+
+    found = {}
+    for i in range(n):
+        for (j, fd) in zip(columns[i], results[i]):
+            found[(i, j)] = fd
+    hogs = {}
+    for i in range(n):
+        for j in range(n):
+            hogs[CHARS[i] + CHARS[j]] = found[(i, j)] if (i, j) in found else found[(j, i)]
+    return hogs
+
+
+# Stage: normalize each histogram to the luminance of the character-pair, {pair: list}
+def table_features(hogs, luminances):
     fds = {}
-    chars = []
-    images = []
-    for i in range(STARTCHAR, ENDCHAR + 1):
-        for j in range(STARTCHAR, ENDCHAR + 1):
-            c1 = chr(i)
-            c2 = chr(j)
-            cc = c1 + c2
-
-            img, edges1, edges2 = chars_image(c1, c2)
-            char = img[rowbounds[0]: rowbounds[1], colbounds[0]: colbounds[1]]
-
-            # Keep a small set for visual inspection
-            if c1 in " #$012345AFJKLMWXY^_" and c2 in " =_":
-                chars.append(char)
-
-            (fd, image) = hog_char(char, luminances[cc])
+    for (cc, fd) in hogs.items():
+        fds[cc] = hog.scale_to_luminance(fd.copy(), luminances[cc]).tolist()
+    return fds
+
+
+def analyze_table_image(float16=False, workers=None, fold=False, cache_dir=CACHE_DIR, float32=False,
+                        report_memory=False):
+    # Each stage is cached, and only recomputed when its parameters, its code (the function and what it
+    # depends on), or an earlier stage change
+    report = memory.MemoryReport(report_memory)
+    build = stages.Build(cache_dir, enabled=cache_dir is not None, report=report)
+    source = build.source("chars_overstrike.jpg")
+    scan = build.stage("scan", load_image, [source], rotation=ROTATION, shear=SHEAR, translation=TRANSLATION, k=10,
+                       dtype="float32" if float32 else "float64")
+    cells = build.stage("cells", table_cells, [scan], depends=[crop_cells, ink_edges, CHARS], threshold=0.4,
+                        left=CHARS_LEFTMARGIN, top=CHARS_TOPMARGIN, rowheight=CHARS_ROWHEIGHT,
+                        charwidth=CHARS_CHARWIDTH)
+    bounds = build.stage("bounds", table_bounds, [cells])
+    rawlums = build.stage("luminances", table_luminances, [cells], depends=[luminance, CHARS])
+    luminances = build.stage("levels", normalize_luminances, [rawlums], fudg=0.05)
+    hogs = build.stage("hog", table_hogs, [cells, bounds], options=dict(workers=workers),
+                       depends=[hog_chars, hog_char, CHARS], fold=fold, brows=BROWS, bcols=BCOLS, block_norm='L1')
+    features = build.stage("features", table_features, [hogs, luminances], depends=[hog.scale_to_luminance])
 
-            fds[cc] = fd.tolist()
-            images.append(image)
-
-    # Save a combined image of HOGs
-#    im = np.concatenate(tuple(images))
-#    im *= 1 / im.max()
-#    imageio.imsave("overstrike.png", im)
+    # characters sorted by increasing luminance
+    sl = sorted(rawlums.value, key=rawlums.value.get)
+    for c in sl:
+        print("\"{}\", {}".format(c, luminances.value[c]))
 
-#    # Save a combined image of characters
-    im = np.concatenate(tuple(chars))
-    im *= 1 / im.max()
-    # imageio.imsave("overstrike1.png", im)
+    bylum = "".join(sl)
+    print(bylum)
 
-    im = np.concatenate(tuple(chars), axis=1)
-    im *= 1 / im.max()
-    # imageio.imsave("overstrike2.png", im)
+    fds = features.value
 
     # Save the JSON
     with io.open("chars_overstrike.json", "w") as afile:
         json.dump(fds, afile, indent=2)
 
+    # Save the binary atlas, which the renderers memory-map instead of parsing the JSON
+    atlas.write("chars_overstrike.atlas", fds, dtype=np.float16 if float16 else np.float32)
+    report.summary()
+
 
 def print_table():
     # Print the "all combinations" ASCII overstrike table.
@@ -282,11 +273,19 @@ def print_table():
 
 @click.command()
 @click.option('--table', is_flag=True, default=False, help='Print the overstrike table')
-def main(table):
+@click.option('--float16', is_flag=True, default=False, help='Store the binary atlas as float16')
+@click.option('--workers', type=int, help='Number of processes for the HOG (default: one per CPU)')
+@click.option('--fold', is_flag=True, default=False,
+              help='Analyze each pair once, and use the same data for (c2, c1) as (c1, c2)')
+@click.option('--cache', 'cache_dir', default=CACHE_DIR, help='Directory for the cached build stages')
+@click.option('--no-cache', is_flag=True, default=False, help='Recompute everything, and don\'t cache it')
+@click.option('--float32', is_flag=True, default=False, help='Process the scan in single precision (half the memory)')
+@click.option('--report-memory', is_flag=True, default=False, help='Print the memory used by each stage')
+def main(table, float16, workers, fold, cache_dir, no_cache, float32, report_memory):
     if table:
         print_table()
     else:
-        analyze_table_image()
+        analyze_table_image(float16, workers, fold, None if no_cache else cache_dir, float32, report_memory)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Print an image using ASCII text, with the render daemon (renderd.py) if it's running.
+
+This takes the same options as image2.py, e.g.
+    renderc.py --width 40 --gamma 2.0 --chars1 "'." --chars2 "0-" --output - picture.png
+The daemon doesn't do --workers, --report-memory, --profile or --profile-matcher (they're about
+the process doing the work), so with any of those this runs image2.py itself.
+
+It only imports the standard library (and click), so it starts quickly.  The daemon already has the image
+libraries imported and the character atlas loaded, so it can start printing straight away.
+If there's no daemon listening, this just runs image2.py instead.
+The socket is $ASCIIART_SOCKET, or "asciiart-<uid>.sock" in the temp directory.
+
+The protocol, over a Unix socket:
+- the client sends one line of JSON with the image2 options, then the image file, then shuts down its side;
+- the daemon replies "OK" and a newline, then the text as it's rendered; or "ERROR", a message and a newline.
+"""
+
+import os
+import sys
+import json
+import socket
+import tempfile
+import click
+
+
+# The same as encode.BAUD and encode.BITS_PER_CHAR (encode isn't imported, to keep this quick)
+BAUD = 110
+BITS_PER_CHAR = 11
+
+
+SOCKET = os.environ.get("ASCIIART_SOCKET") or os.path.join(tempfile.gettempdir(),
+                                                           "asciiart-{}.sock".format(os.getuid()))
+
+IMAGE2 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image2.py")
+
+CHUNK = 4096
+
+
+def request(options, image, path=SOCKET):
+    """
+    Ask the daemon to render an image.
+    :param options: dictionary of image2 options (width, gamma, chars1, ...)
+    :param image: contents of the image file (bytes)
+    :param path: the daemon's socket
+    :return: socket file to read the text from.  Raises OSError if the daemon isn't there,
+             or RuntimeError if it couldn't render the image.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(options).encode("utf-8") + b"\n")
+        sock.sendall(image)
+        sock.shutdown(socket.SHUT_WR)
+        f = sock.makefile("rb")
+    finally:
+        # The file keeps the connection open
+        sock.close()
+    status = f.readline().decode("utf-8").rstrip("\n")
+    if status != "OK":
+        f.close()
+        raise RuntimeError(status or "ERROR no reply from the render daemon")
+    return f
+
+
+@click.command()
+@click.option('--width', default=66, help='Image width (characters)')
+@click.option('--invert', is_flag=True, default=False, help='Invert colors')
+@click.option('--gamma', default=1.0, help='Gamma correction')
+@click.option('--indent', default=0, help='Indent with spaces')
+@click.option('--chars1', help='Characters to use in the first layer')
+@click.option('--chars2', help='Characters to use in the second layer')
+@click.option('--title', help='Title text')
+@click.option('--output', help='Output filename (use "-" for stdout)')
+@click.option('--search', type=click.Choice(["brute", "index"]), default="brute",
+              help='Compare with every character, or use the nearest-neighbour index')
+@click.option('--approximate', default=0.0, help='Index search tolerance (0 = exact)')
+@click.option('--layers', type=click.IntRange(2, 3), default=2, help='Layers of overstrike (3 for triple-strike)')
+@click.option('--chars3', help='Characters to use in the third layer')
+@click.option('--beam', type=click.IntRange(1), default=8,
+              help='Triple-strike: how many character-pairs to extend for each block')
+@click.option('--stream', is_flag=True, default=False, help='(The daemon always streams)')
+@click.option('--cache', 'cache_dir', help='Directory to cache the results in')
+@click.option('--cache-size', default=64, help='Cache size limit (MB)')
+@click.option('--tie-break', default=0.0,
+              help='Prefer the lightest character-pair within this fraction of the best match (e.g. 0.02)')
+@click.option('--baud', default=BAUD, help='Line speed, for the estimated print time')
+@click.option('--float32', is_flag=True, default=False, help='Process the image in single precision (half the memory)')
+@click.option('--workers', type=click.IntRange(1), default=1, help='Number of processes for the matching (runs image2.py)')
+@click.option('--report-memory', is_flag=True, default=False,
+              help='Print the memory used by each stage (runs image2.py)')
+@click.option('--profile', help='Write the time spent in each stage to this file (runs image2.py)')
+@click.option('--profile-matcher', help='Write a cProfile dump of the matching to this file (runs image2.py)')
+@click.argument('filename')
+def main(filename, width, invert, gamma, indent, chars1, chars2, title, output, search, approximate,
+         layers, chars3, beam, stream, cache_dir, cache_size, tie_break, baud, float32,
+         workers, report_memory, profile, profile_matcher):
+    if layers > 2 and (search != "brute" or approximate or tie_break):
+        raise click.UsageError("--layers 3 compares with every character, "
+                               "so it can't use --search index, --approximate or --tie-break")
+    if workers > 1 or report_memory or profile or profile_matcher:
+        # Options the daemon doesn't have: do it ourselves
+        os.execv(sys.executable, [sys.executable, IMAGE2] + sys.argv[1:])
+    options = dict(width=width, invert=invert, gamma=gamma, indent=indent, chars1=chars1, chars2=chars2,
+                   title=title, search=search, approximate=approximate, layers=layers, chars3=chars3, beam=beam,
+                   tie_break=tie_break, float32=float32)
+    if cache_dir:
+        options.update(cache=os.path.abspath(os.path.expanduser(cache_dir)), cache_size=cache_size * 1024 * 1024)
+    with open(filename, "rb") as f:
+        image = f.read()
+
+    try:
+        text = request(options, image)
+    except OSError:
+        # No daemon: do it ourselves (image2.py takes the same arguments)
+        os.execv(sys.executable, [sys.executable, IMAGE2] + sys.argv[1:])
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    # Copy the text as it arrives
+    if not output:
+        output = filename + ".txt"
+    if output == "-":
+        output = 1
+    count = 0
+    with text, open(output, "wb") as f:
+        while True:
+            chunk = text.read1(CHUNK)
+            if not chunk:
+                break
+            f.write(chunk)
+            f.flush()
+            count += len(chunk)
+
+    seconds = int(round(count * BITS_PER_CHAR / baud))
+    print("{} bytes, about {}m{:02d}s to print at {} baud".format(count, seconds // 60, seconds % 60, baud),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
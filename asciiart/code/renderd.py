@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Render daemon: image2, with everything already loaded.
+
+Running image2.py for each picture spends most of its time getting ready (importing skimage and imageio,
+and loading the character atlas) before it looks at the image.  This keeps all that in one long-running
+process, listening on a Unix socket, and renders each request in streaming mode, sending the text back
+as each row is done.  Use renderc.py to send it pictures, with the same options as image2.py.
+
+    python renderd.py &
+    python renderc.py --width 40 --output - picture.png
+
+With --profile, it times the stages of each render (see instrument.py), and appends them to a file as JSON lines,
+with the running totals over all the renders so far.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import itertools
+import io
+import socketserver
+import threading
+import numpy as np
+import click
+import imageio
+import atlas
+import cache
+import image2
+import instrument
+import renderc
+
+
+# Render caches, by directory
+render_caches = {}
+
+# Where to write the stage timings (see --profile), and their totals so far
+profile = dict(filename=None, totals=instrument.Profiler(), renders=0, lock=threading.Lock())
+
+
+def render(image, width=66, invert=False, gamma=1.0, indent=0, chars1=None, chars2=None, title=None,
+           search="brute", approximate=0.0, layers=image2.ROUNDS, chars3=None, beam=8, tie_break=0.0, float32=False):
+    """
+    Render an image, the same as image2.py --stream would.
+    :param image: the decoded image
+    :return: (generator of the text for each row, title bytes)
+    """
+    if title:
+        title = image2.format_title(title, width, indent)
+    dtype = np.float32 if float32 else None
+    fd = image2.stream_image(image, width, invert, gamma, dtype=dtype or np.float64)
+    rows = image2.render_rows(fd, chars1, chars2, indent, search, approximate, layers, chars3, beam,
+                              tie_break=tie_break, dtype=dtype)
+    return rows, title
+
+
+def get_cache(directory, max_size):
+    if directory not in render_caches:
+        render_caches[directory] = cache.RenderCache(directory, max_size)
+    render_caches[directory].max_size = max_size
+    return render_caches[directory]
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        profiler = instrument.Profiler() if profile["filename"] else None
+        with instrument.profiling(profiler):
+            self.respond()
+        if profiler is not None and profiler.totals:
+            log_profile(profiler)
+
+    def respond(self):
+        started = time.time()
+        render_cache = text = None
+        try:
+            options = json.loads(self.rfile.readline().decode("utf-8"))
+            cache_dir = options.pop("cache", None)
+            cache_size = options.pop("cache_size", cache.MAX_SIZE)
+            with instrument.stage("decode"):
+                pixels = imageio.imread(self.rfile.read())
+            if cache_dir:
+                # Same cache (and keys) as image2.py --cache
+                render_cache = get_cache(cache_dir, cache_size)
+                key = image2.cache_key(render_cache, pixels, options)
+                text = render_cache.get(key)
+            if text is None:
+                rows, title = render(pixels, **options)
+                # Render the first row before we say OK, so that a bad image or bad options can be reported
+                rows = itertools.chain([next(rows)], rows)
+        except Exception as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            self.wfile.write("ERROR {}".format(e).replace("\n", " ").encode("utf-8") + b"\n")
+            return
+
+        try:
+            self.wfile.write(b"OK\n")
+            if text is not None:
+                self.wfile.write(text)
+            elif render_cache is not None:
+                record = io.BytesIO()
+                image2.write_rows(rows, image2.Tee(self.wfile, record), title)
+                render_cache.put(key, record.getvalue())
+            else:
+                image2.write_rows(rows, self.wfile, title)
+        except (BrokenPipeError, ConnectionResetError):
+            print("Client went away", file=sys.stderr)
+            return
+        print("Rendered {}x{} image, width {}, in {:.3f}s{}".format(
+            pixels.shape[1], pixels.shape[0], options.get("width"), time.time() - started,
+            " (cached)" if text is not None else ""), file=sys.stderr)
+
+
+def log_profile(profiler):
+    """Add a render's stage timings to the totals, and append both to the profile file"""
+    with profile["lock"]:
+        profile["totals"].merge(profiler)
+        profile["renders"] += 1
+        with io.open(profile["filename"], "a") as f:
+            profiler.write(f, render=profile["renders"])
+            profile["totals"].write(f, render=profile["renders"], total=True)
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def warm_up():
+    """Load the character atlases, and touch all their pages so that the first request doesn't wait for them"""
+    for filename in (image2.PREPARED_FILE, image2.SINGLES_FILE):
+        if os.path.exists(filename) or os.path.exists(atlas.atlas_filename(filename)):
+            chars = atlas.load(filename)
+            chars.features.sum()
+
+
+@click.command()
+@click.option('--socket', 'path', default=renderc.SOCKET, help='Unix socket to listen on')
+@click.option('--profile', 'profile_file', help='Append the time spent in each stage of each render to this file')
+def main(path, profile_file):
+    profile["filename"] = profile_file
+    # Clear up after a previous daemon, unless it's still running
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            sys.exit("Already running on {}".format(path))
+        except ConnectionRefusedError:
+            os.unlink(path)
+
+    warm_up()
+    server = RenderServer(path, RenderHandler)
+    os.chmod(path, 0o600)
+    print("Listening on {}".format(path), file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
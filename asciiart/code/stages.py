@@ -0,0 +1,156 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Cached, dependency-tracked build stages for the prep scripts.
+
+Preparing the character data is a chain of stages, e.g.
+    scan -> cells -> bounds -> luminances -> HOG -> features
+and most of the time goes into the first few (warping the 600dpi scan, cropping the table),
+while the parameters we tune are usually in the last few.
+
+Each stage's result is saved in the cache directory, keyed by a hash of
+- the stage name and the source code of its function,
+- the source code of everything else the function uses, which has to be listed as the stage's
+  'depends' (the functions it calls, other modules, and module constants such as the character list),
+- its parameters, and
+- the keys of its input stages (for a source file, the file's contents).
+So after changing a parameter, only that stage and the stages downstream of it are recomputed.
+Results are only loaded when they're needed: if the HOG is already cached, the scan isn't even read.
+"""
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import inspect
+import tempfile
+import memory
+import instrument
+
+
+CACHE_DIR = ".prep_cache"
+
+# How many results to keep for each stage (so that switching a parameter back and forth is quick)
+KEEP = 2
+
+
+def source_of(dependency):
+    """:return: the source code of a function, class or module, or the repr of anything else"""
+    if inspect.isfunction(dependency) or inspect.isclass(dependency) or inspect.ismodule(dependency):
+        return inspect.getsource(dependency)
+    return repr(dependency)
+
+
+class Stage(object):
+
+    def __init__(self, build, name, func, inputs=(), params=None, options=None, depends=()):
+        """
+        :param build: the Build that caches this stage
+        :param name: stage name (for the cache files and the log)
+        :param func: computes the result, func(*input values, **params, **options)
+        :param inputs: the upstream stages
+        :param params: keyword parameters, part of the key
+        :param options: keyword parameters that don't change the result (e.g. number of workers)
+        :param depends: functions, classes or modules that func uses (their source is part of the key),
+                        or other values that change the result (their repr is part of the key)
+        """
+        self.build = build
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.options = options or {}
+        self.depends = list(depends)
+        self.key = self.make_key()
+        self.done = False
+        self.result = None
+
+    def make_key(self):
+        h = hashlib.sha256()
+        h.update(self.name.encode("utf-8"))
+        h.update(inspect.getsource(self.func).encode("utf-8"))
+        for dependency in self.depends:
+            h.update(source_of(dependency).encode("utf-8"))
+        h.update(repr(sorted(self.params.items())).encode("utf-8"))
+        for stage in self.inputs:
+            h.update(stage.key.encode("utf-8"))
+        return h.hexdigest()
+
+    @property
+    def value(self):
+        if not self.done:
+            self.result = self.build.load_or_compute(self)
+            self.done = True
+        return self.result
+
+
+class Source(Stage):
+    """A source file.  The key is a hash of its contents, and the value is the filename."""
+
+    def __init__(self, build, filename):
+        self.filename = filename
+        super(Source, self).__init__(build, "source", None)
+        self.done = True
+        self.result = filename
+
+    def make_key(self):
+        h = hashlib.sha256()
+        with open(self.filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+class Build(object):
+
+    def __init__(self, directory=CACHE_DIR, enabled=True, report=None):
+        """
+        :param directory: where to keep the stage results
+        :param enabled: False to compute everything (and not save anything)
+        :param report: memory.MemoryReport, for the memory used by each stage
+        """
+        self.directory = directory
+        self.enabled = enabled
+        self.report = report or memory.MemoryReport(enabled=False)
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def source(self, filename):
+        return Source(self, filename)
+
+    def stage(self, name, func, inputs=(), options=None, depends=(), **params):
+        return Stage(self, name, func, inputs, params, options, depends)
+
+    def _path(self, stage):
+        return os.path.join(self.directory, "{}-{}.pickle".format(stage.name, stage.key[:16]))
+
+    def load_or_compute(self, stage):
+        path = self._path(stage) if self.enabled else None
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+            print("{}: cached".format(stage.name), file=sys.stderr)
+            return value
+
+        inputs = [upstream.value for upstream in stage.inputs]
+        started = time.time()
+        with self.report.stage(stage.name), instrument.stage(stage.name):
+            value = stage.func(*inputs, **dict(stage.params, **stage.options))
+        print("{}: {:.1f}s".format(stage.name, time.time() - started), file=sys.stderr)
+        if self.enabled:
+            (fd, temp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+            self.prune(stage.name)
+        return value
+
+    def prune(self, name):
+        """Remove all but the most recent KEEP results for a stage"""
+        prefix = name + "-"
+        entries = [entry for entry in os.scandir(self.directory)
+                   if entry.name.startswith(prefix) and entry.name.endswith(".pickle")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[KEEP:]:
+            os.unlink(entry.path)
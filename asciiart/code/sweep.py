@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""Render a picture with a grid of different options, to find the best-looking settings.
+
+Each option can be given several times, and every combination is rendered, e.g.
+    python sweep.py --width 40 --width 66 --gamma 1.0 --gamma 1.5 --chars2 "" --chars2 "-/MO0N\\FULL" picture.jpg
+
+The width, gamma and invert change the image HOG; the character sets only change the matching.
+So the image is analyzed once for each (width, gamma, invert), and only the matching is repeated
+for each character set.
+
+Each variant is written to the output directory (picture.jpg.sweep by default), with a summary
+(sweep.json, and a table on stdout) of the timings and a simple score for each:
+- ink: the mean luminance of the printed characters (0 = blank paper, 1 = the darkest overstrike)
+- contrast: the standard deviation of that luminance over the picture
+- match: the correlation between the printed luminance and the luminance of the image
+"""
+
+import os
+import io
+import json
+import time
+import itertools
+import numpy as np
+import imageio
+import click
+import atlas
+import matcher
+import encode
+import image2
+
+
+def block_luminances(fd):
+    """The luminance of each character-sized block of the image HOG, (block_rows, block_cols)"""
+    blocks = matcher.blocks(fd, image2.BROWS, image2.BCOLS)
+    return blocks.reshape(blocks.shape[:2] + (-1,)).mean(axis=-1)
+
+
+def printed_luminances(strikes):
+    """
+    The luminance of each printed character-pair.
+    :param strikes: the character-pair for each block, (from image2.Matcher.strikes, before encoding
+                    moves the characters into the earliest layers, which would change the pairs)
+    :return: (block_rows, block_cols)
+    """
+    chars = atlas.load(image2.PREPARED_FILE)
+    lums = dict(zip(chars.keys, chars.luminances))
+    return np.array([[lums.get(pair, 0.0) for pair in row] for row in strikes])
+
+
+def score(printed, target):
+    """:return: dictionary of ink, contrast and match (see above)"""
+    if printed.std() > 0 and target.std() > 0:
+        match = np.corrcoef(printed.ravel(), target.ravel())[0, 1]
+    else:
+        match = 0.0
+    return dict(ink=float(printed.mean()), contrast=float(printed.std()), match=float(match))
+
+
+def sweep(filename, outdir, widths, gammas, inverts, charsets, indent=0, search="brute"):
+    """
+    Render every combination of the options.
+    :param charsets: list of (chars1, chars2)
+    :return: list of dictionaries, one per variant, with the options, timings, score, and output filename
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    # Read the file once for everything
+    source = imageio.imread(filename)
+
+    results = []
+    for (width, gamma, invert) in itertools.product(widths, gammas, inverts):
+        started = time.time()
+        img = image2.load_image(source, width, invert, gamma)
+        fd = image2.process(img)
+        analyzed = time.time() - started
+        target = block_luminances(fd)
+
+        for (chars1, chars2) in charsets:
+            # (As image2.render_rows does, but keeping the strikes for the score)
+            started = time.time()
+            chars = image2.Matcher(chars1, chars2, search)
+            strikes = [chars.strikes(row) for row in matcher.blocks(fd, image2.BROWS, image2.BCOLS)]
+            rows = [encode.encode_row(image2.layer_lines(row, chars.layers), indent) for row in strikes]
+            rendered = time.time() - started
+
+            name = "{:03d}.txt".format(len(results) + 1)
+            with io.open(os.path.join(outdir, name), "wb") as f:
+                image2.write_rows(rows, f)
+
+            result = dict(file=name, width=width, gamma=gamma, invert=invert, chars1=chars1, chars2=chars2,
+                          analyze_time=analyzed, render_time=rendered)
+            result.update(score(printed_luminances(strikes), target))
+            results.append(result)
+
+    with io.open(os.path.join(outdir, "sweep.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+@click.command()
+@click.option('--width', 'widths', multiple=True, type=int, help='Image width (characters), can be repeated')
+@click.option('--gamma', 'gammas', multiple=True, type=float, help='Gamma correction, can be repeated')
+@click.option('--invert', 'inverts', multiple=True, type=bool,
+              help='Invert colors (true/false), can be repeated to try both')
+@click.option('--chars1', multiple=True, help='Characters to use in the first layer, can be repeated ("" for all)')
+@click.option('--chars2', multiple=True, help='Characters to use in the second layer, can be repeated ("" for all)')
+@click.option('--indent', default=0, help='Indent with spaces')
+@click.option('--search', type=click.Choice(["brute", "index"]), default="brute",
+              help='Compare with every character, or use the nearest-neighbour index')
+@click.option('--output', help='Output directory (default: the filename + ".sweep")')
+@click.argument('filename')
+def main(filename, widths, gammas, inverts, chars1, chars2, indent, search, output):
+    if not output:
+        output = filename + ".sweep"
+
+    charsets = list(itertools.product(chars1 or [None], chars2 or [None]))
+    results = sweep(filename, output, widths or [66], gammas or [1.0], inverts or [False], charsets, indent, search)
+
+    print("{:8} {:>5} {:>5} {:>6} {:16} {:16} {:>7} {:>7} {:>5} {:>8} {:>5}".format(
+        "file", "width", "gamma", "invert", "chars1", "chars2", "analyze", "render", "ink", "contrast", "match"))
+    for r in results:
+        print("{:8} {:5d} {:5.2f} {!s:>6} {:16} {:16} {:6.2f}s {:6.2f}s {:5.3f} {:8.3f} {:5.3f}".format(
+            r["file"], r["width"], r["gamma"], r["invert"], r["chars1"] or "-", r["chars2"] or "-",
+            r["analyze_time"], r["render_time"], r["ink"], r["contrast"], r["match"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""The exact index search gives the same characters as the exhaustive search, including ties.
+
+    python -m pytest test_charindex.py
+"""
+
+import numpy as np
+import charindex
+import matcher
+
+
+def folded(n, copies, seed=0):
+    """
+    Character features with duplicates (as in a folded atlas, where XY and YX have the same histogram),
+    each one repeated 'copies' times, shuffled.
+    :return: (features (N, 4, 3, 8), luminances (N,))
+    """
+    rng = np.random.RandomState(seed)
+    features = np.repeat(rng.uniform(size=(n, 4, 3, 8)), copies, axis=0)
+    order = rng.permutation(len(features))
+    features = features[order]
+    return features, features.reshape(len(features), -1).mean(axis=1)
+
+
+def blocks(features, seed=1):
+    """Blocks exactly on some of the characters (so that all their copies tie), and some random ones"""
+    rng = np.random.RandomState(seed)
+    exact = features[rng.choice(len(features), 100)]
+    return np.concatenate([exact, rng.uniform(size=(100,) + features.shape[1:])])
+
+
+def check(features, luminances, bucket_size):
+    index = charindex.CharIndex(features, luminances, bucket_size=bucket_size)
+    b = blocks(features)
+    expected = matcher.best_matches(b, features, luminances)
+    assert np.array_equal(index.best_matches(b), expected)
+
+
+def test_ties():
+    for copies in (2, 3):
+        features, luminances = folded(200, copies)
+        for bucket_size in (16, 64, 256):
+            check(features, luminances, bucket_size)
+
+
+def test_more_ties_than_neighbours():
+    features, luminances = folded(50, charindex.TIES + 4)
+    for bucket_size in (16, 64, 1024):
+        check(features, luminances, bucket_size)
@@ -0,0 +1,39 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""image2 --float32 changes the output no more than drift.py allows, on some synthetic pictures.
+
+    python -m pytest test_drift.py
+"""
+
+import os
+import numpy as np
+import pytest
+import atlas
+import bench
+import drift
+import image2
+
+
+pytestmark = pytest.mark.skipif(
+    not (os.path.exists(image2.PREPARED_FILE) or os.path.exists(atlas.atlas_filename(image2.PREPARED_FILE))),
+    reason="needs the overstrike atlas (run prep_overstrike.py)")
+
+
+def pictures():
+    """Flat areas and straight edges (where rounding decides the HOG bins), and a mixture with some noise"""
+    checkerboard = bench.checkerboard()
+    mixture = np.clip(0.7 * bench.gradient() + 0.3 * bench.checkerboard(square=32) + 0.2 * bench.noise(), 0, 1)
+    return [np.dstack([img] * 3) for img in (checkerboard, mixture)]
+
+
+@pytest.fixture(scope="module")
+def matchers():
+    return image2.Matcher(), image2.Matcher(dtype=np.float32)
+
+
+@pytest.mark.parametrize("width", [40, 72])
+def test_float32_drift(matchers, width):
+    for img in pictures():
+        d = drift.drift(img, width, *matchers)
+        assert d["changed"] <= d["floor"]
+        assert d["match64"] - d["match32"] <= drift.MATCH_BOUND
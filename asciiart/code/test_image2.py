@@ -0,0 +1,102 @@
+# Copyright (c) Hugh Pyle 2018.   MIT license.
+
+"""The vectorized image2.hog_image() gives the same fd as the skimage HOG and per-cell loops it replaced.
+
+    python -m pytest test_image2.py
+"""
+
+import sys
+import numpy as np
+import image2
+from skimage import feature
+
+
+def hog_image_loops(image, pad=np.resize):
+    """
+    The HOG of an image as process() used to do it: skimage's HOG, and one cell at a time
+    for the dots and the luminance (and padding with np.resize)
+    """
+    image = image.copy()
+    (rows, cols) = image.shape
+    cellsize = image2.CELLPX
+
+    # Make sure the image is a multiple of 4x3 x cellsize in both dimensions
+    rn = cellsize * image2.BROWS
+    cn = cellsize * image2.BCOLS
+    newshape = (((rows + rn - 1) // rn) * rn, ((cols + cn - 1) // cn) * cn)
+    if newshape != image.shape:
+        image = pad(image, newshape)
+        (rows, cols) = image.shape
+    n_cells_row = int(rows // cellsize)  # number of cells along row-axis
+    n_cells_col = int(cols // cellsize)  # number of cells along col-axis
+
+    # Put a dot in the middle of each cell, so that the HOG
+    # doesn't end up as exactly zero for areas with no gradient
+    for iy in range(0, n_cells_row):
+        for ix in range(0, n_cells_col):
+            px = ix * cellsize
+            py = iy * cellsize
+            image[py + int(cellsize / 2), px + int(cellsize / 2)] += 0.001
+            image[py + int(cellsize / 2), px + int(cellsize / 2)+1] += 0.001
+            image[py + int(cellsize / 2)+1, px + int(cellsize / 2)] += 0.001
+            image[py + int(cellsize / 2)+1, px + int(cellsize / 2)+1] += 0.001
+
+    # HOG the whole image
+    fd = feature.hog(image,
+                     orientations=image2.HOG_ORIENTATIONS,
+                     pixels_per_cell=(cellsize, cellsize),
+                     cells_per_block=(1, 1),
+                     block_norm='L1',
+                     feature_vector=False)
+    fd = np.squeeze(fd)
+
+    # Normalize each histogram to the luminance of the block it derived from
+    for iy in range(0, n_cells_row):
+        for ix in range(0, n_cells_col):
+            px = ix * cellsize
+            py = iy * cellsize
+            cell = image[py: py + cellsize, px: px + cellsize]
+            luminance = cell.mean()
+            fd_cell = fd[iy, ix]
+            fdm = fd_cell.mean()
+            fd_cell *= luminance / (fdm + sys.float_info.epsilon)
+
+    return fd
+
+
+def pad_blank(image, newshape):
+    """Pad with zeros at the bottom and right, as hog_image() does"""
+    return np.pad(image, ((0, newshape[0] - image.shape[0]), (0, newshape[1] - image.shape[1])))
+
+
+def picture(rows, cols):
+    """Some noise, smoothed a little so that the gradients have some structure"""
+    img = np.random.RandomState(rows * cols).uniform(size=(rows, cols))
+    return (img + np.roll(img, 1, axis=0) + np.roll(img, 1, axis=1)) / 3
+
+
+# skimage accumulates the histograms in single precision, hog.py in double
+TOLERANCE = 1e-5
+
+
+def test_whole_blocks():
+    # (image2 always resizes to a whole number of blocks across: 3 * width * CELLPX)
+    for (rows, cols) in [(64, 48), (192, 144), (256, 480)]:
+        img = picture(rows, cols)
+        fd = image2.hog_image(img.copy())
+        assert np.allclose(fd, hog_image_loops(img), rtol=0, atol=TOLERANCE)
+
+
+def test_padded_rows():
+    for (rows, cols) in [(100, 144), (200, 480), (65, 48)]:
+        img = picture(rows, cols)
+        fd = image2.hog_image(img.copy())
+        # The padding is blank, where np.resize used to wrap around and repeat the top of the picture
+        assert np.allclose(fd, hog_image_loops(img, pad=pad_blank), rtol=0, atol=TOLERANCE)
+        # So the cells of the picture (except those next to the padding, whose gradient sees it) are unchanged,
+        # and only the padded row of blocks is different
+        full_cells = rows // image2.CELLPX - 1
+        old = hog_image_loops(img)
+        assert fd.shape == old.shape
+        assert np.allclose(fd[:full_cells], old[:full_cells], rtol=0, atol=TOLERANCE)
+        assert not np.allclose(fd[full_cells + 1:], old[full_cells + 1:], rtol=0, atol=TOLERANCE)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Hugh Pyle
+
+"""
+Compiled BDF fonts, for writing text on paper-tape (used by 'tf' and the "text" operator in 'pattern').
+
+PIL can only draw with a BDF font after saving it as a .pil/.pbm pair and loading that again,
+which takes much longer than punching a few letters.  Instead, each font is compiled once to
+the columns of each glyph (as integers, one bit per pixel, the top row in the lowest bit),
+with the glyph's advance and position, and saved in the cache directory
+($XDG_CACHE_HOME/asr33/glyphs, or ~/.cache/asr33/glyphs), keyed by a hash of the font file.
+After that, text is just the glyph columns side by side.
+
+The layout is the same as PIL's: each glyph is placed at its offset from the baseline and the
+current position, and overwrites whatever was there (within its bounding box).
+
+To compile all the fonts in advance:
+    python glyphcache.py
+"""
+
+import os
+import sys
+import pickle
+import hashlib
+import tempfile
+import click
+from PIL import BdfFontFile
+
+
+# Font files are in a subdirectory 'fonts'
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+
+# Change this when the compiled format changes
+VERSION = 1
+
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "asr33", "glyphs")
+
+# Fonts already loaded by this process, by filename
+loaded = {}
+
+
+def shift(value, n):
+    """Shift bits left by 'n' (right if n is negative)"""
+    return value << n if n >= 0 else value >> -n
+
+
+class Glyphs(object):
+    """The compiled glyphs of a font"""
+
+    def __init__(self, glyphs):
+        """
+        :param glyphs: for each character code 0-255, None or a tuple of
+                       (advance (dx, dy), box (x0, y0, x1, y1) relative to the origin, columns)
+        """
+        self.glyphs = glyphs
+        # The line runs from the highest top to the lowest bottom of all the glyphs (including the origin)
+        boxes = [glyph[1] for glyph in glyphs if glyph]
+        self.baseline = -min([0] + [box[1] for box in boxes])
+        self.ysize = max([0] + [box[3] for box in boxes]) + self.baseline
+
+    def getsize(self, text):
+        """:return: (width, height) in pixels of a line of text"""
+        codes = text.encode("latin-1")
+        return sum(self.glyphs[c][0][0] for c in codes if self.glyphs[c]), self.ysize
+
+    def columns(self, text):
+        """
+        :return: the columns of a line of text, as integers (the top row in the lowest bit), the size of getsize()
+        """
+        (width, height) = self.getsize(text)
+        rows = (1 << height) - 1
+        result = [0] * width
+        (x, y) = (0, self.baseline)
+        # As with PIL, only the first line is drawn (the space is for all the text, and the rest falls off the bottom)
+        for c in text.split("\n")[0].encode("latin-1"):
+            glyph = self.glyphs[c]
+            if not glyph:
+                continue
+            ((dx, dy), (x0, y0, x1, y1), columns) = glyph
+            # The glyph replaces its whole bounding box (clipped to the line)
+            mask = shift((1 << (y1 - y0)) - 1, y + y0) & rows
+            for (i, column) in enumerate(columns):
+                pos = x + x0 + i
+                if 0 <= pos < width:
+                    result[pos] = (result[pos] & ~mask) | (shift(column, y + y0) & rows)
+            x += dx
+            y += dy
+        return result
+
+
+def compile_font(font_filename):
+    """Read a BDF font, :return: Glyphs"""
+    with open(font_filename, "rb") as font_file:
+        bdf = BdfFontFile.BdfFontFile(font_file)
+    glyphs = []
+    for glyph in bdf.glyph:
+        if glyph is None:
+            glyphs.append(None)
+            continue
+        (advance, box, _, image) = glyph
+        (width, height) = image.size
+        pixels = image.load()
+        columns = [sum(1 << y for y in range(height) if pixels[x, y]) for x in range(width)]
+        glyphs.append((advance, box, columns))
+    return Glyphs(glyphs)
+
+
+def checked(glyphs):
+    """:return: the glyphs loaded from the cache, if they're what compile_font makes (otherwise raise ValueError)"""
+    if not (isinstance(glyphs, list) and len(glyphs) == 256 and
+            all(glyph is None or (isinstance(glyph, tuple) and len(glyph) == 3 and len(glyph[0]) == 2 and
+                                  len(glyph[1]) == 4 and all(isinstance(c, int) for c in glyph[2]))
+                for glyph in glyphs)):
+        raise ValueError("Not a compiled font")
+    return glyphs
+
+
+def cache_filename(font_filename):
+    """The compiled font's filename in the cache, keyed by the contents of the font file"""
+    with open(font_filename, "rb") as font_file:
+        digest = hashlib.sha256(font_file.read()).hexdigest()
+    name = os.path.splitext(os.path.basename(font_filename))[0]
+    return os.path.join(CACHE_PATH, "{}-v{}-{}.pickle".format(name, VERSION, digest[:16]))
+
+
+def load(font_filename):
+    """
+    The compiled glyphs of a font: from memory, or from the cache, or compiled (and saved in the cache).
+    :param font_filename: path of a BDF font
+    :return: Glyphs
+    """
+    if font_filename in loaded:
+        return loaded[font_filename]
+    filename = cache_filename(font_filename)
+    try:
+        with open(filename, "rb") as fd:
+            glyphs = Glyphs(checked(pickle.load(fd)))
+    except Exception:
+        # Missing, or unreadable, or not what this version writes: a cache should never stop the tool
+        glyphs = compile_font(font_filename)
+        try:
+            os.makedirs(CACHE_PATH, exist_ok=True)
+            (fd, temp) = tempfile.mkstemp(dir=CACHE_PATH, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(glyphs.glyphs, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, filename)
+        except OSError as exc:
+            # Not being able to cache isn't a reason to stop
+            sys.stderr.write("Can't cache font: {}\n".format(exc))
+    loaded[font_filename] = glyphs
+    return glyphs
+
+
+def text_columns(font_filename, text):
+    """
+    Text as columns of bits, with automatic vertical layout.
+    :return: (columns, height): the integer for each column (the top row in the lowest bit), and the height in bits
+    """
+    glyphs = load(font_filename)
+    columns = glyphs.columns(text)
+    height = glyphs.ysize
+    if height > 8:
+        # The vertical positioning of the text varies by font, but we want "automatic" layout.
+        # Remove any blank lines from the top and bottom.
+        ink = 0
+        for column in columns:
+            ink |= column
+        top = (ink & -ink).bit_length() - 1 if ink else 0
+        height = ink.bit_length() - top if ink else 0
+        columns = [(column >> top) & ((1 << height) - 1) for column in columns]
+    return columns, height
+
+
+@click.command()
+@click.argument("fonts", nargs=-1)
+def main(fonts):
+    """
+    Compile fonts (by name, default: all of them) into the cache.
+    """
+    for font in fonts or sorted(os.path.splitext(name)[0] for name in os.listdir(FONT_PATH) if name.endswith(".bdf")):
+        font_filename = os.path.join(FONT_PATH, "{}.bdf".format(font))
+        glyphs = load(font_filename)
+        print("{}: {} glyphs, {}px high, {}".format(
+            font, sum(1 for glyph in glyphs.glyphs if glyph), glyphs.ysize, cache_filename(font_filename)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Hugh Pyle
+
+"""
+Reading pattern-files (for 'pattern' and 'tapei').
+
+A pattern-file is a Python literal, except that "<" and ">" can be used instead of "{" and "}".
+Only the "<" and ">" of the syntax are replaced (as found by the Python tokenizer), so strings can include them.
+
+Each file is parsed once, and the result is saved in the cache directory
+($XDG_CACHE_HOME/asr33/patterns, or ~/.cache/asr33/patterns), keyed by a hash of the file.
+An index (index.json in the same directory) has the modification time, size and hash of each file,
+so a file that hasn't changed doesn't even need to be read again, and the names of its parts.
+
+To see the parts of every pattern-file:
+    python patternfile.py
+"""
+
+import io
+import os
+import sys
+import ast
+import json
+import pickle
+import hashlib
+import tempfile
+import tokenize
+import click
+
+
+# Pattern files are in a subdirectory 'patterns'
+PATTERN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patterns")
+
+# Change this when the compiled format changes
+VERSION = 2
+
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "asr33", "patterns")
+INDEX_FILENAME = os.path.join(CACHE_PATH, "index.json")
+
+BRACES = str.maketrans("<>", "{}")
+
+
+def translate_braces(expr):
+    """
+    :param expr: Python literal text, using "<" and ">" for braces
+    :return: the text with "{" and "}" instead (but not inside strings or comments)
+    """
+    lines = io.StringIO(expr).readlines()
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(expr).readline))
+    except tokenize.TokenError as exc:
+        raise SyntaxError(str(exc))
+    for token in reversed(tokens):
+        # "<<" is two braces, not a shift
+        if token.type == tokenize.OP and set(token.string) <= set("<>"):
+            (row, col) = token.start
+            line = lines[row - 1]
+            lines[row - 1] = line[:col] + token.string.translate(BRACES) + line[col + len(token.string):]
+    return "".join(lines)
+
+
+def literal_eval(expr):
+    """
+    Evaluate a literal string, that can use <> for braces
+    :param expr: the text
+    :return: object
+    """
+    return ast.literal_eval(translate_braces(expr))
+
+
+def write_atomic(filename, write, mode="wb"):
+    """Write a file in the cache, all at once (so another process never sees half of it)"""
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    (fd, temp) = tempfile.mkstemp(dir=CACHE_PATH, suffix=".tmp")
+    with os.fdopen(fd, mode) as f:
+        write(f)
+    os.replace(temp, filename)
+
+
+def read_index():
+    """:return: the index, {"version", "files": {filename: {"mtime", "size", "sha256", "parts"}}}"""
+    try:
+        with open(INDEX_FILENAME, "r") as fd:
+            index = json.load(fd)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict) or index.get("version") != VERSION or not isinstance(index.get("files"), dict):
+        return {}
+    return index
+
+
+def unchanged(entry, stat):
+    """:return: True if the index entry is for this version of the file (the same modification time and size)"""
+    try:
+        return (entry["mtime"], entry["size"]) == (stat.st_mtime_ns, stat.st_size) and \
+            isinstance(entry["sha256"], str) and isinstance(entry["parts"], list)
+    except (TypeError, KeyError):
+        return False
+
+
+def compile_file(filename, index):
+    """
+    The parsed contents of a pattern-file, from the cache if the file hasn't changed.
+    :param index: the index, updated with this file's entry
+    :return: object
+    """
+    stat = os.stat(filename)
+    entry = index.get("files", {}).get(filename)
+    if unchanged(entry, stat):
+        digest = entry["sha256"]
+        source = None
+    else:
+        with open(filename, "r") as fd:
+            source = fd.read()
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    compiled = os.path.join(CACHE_PATH, "{}-{}.pickle".format(os.path.basename(filename), digest[:16]))
+
+    data = None
+    if os.path.exists(compiled):
+        try:
+            with open(compiled, "rb") as fd:
+                saved = pickle.load(fd)
+            if saved["version"] == VERSION and saved["sha256"] == digest:
+                data = saved["data"]
+        except Exception:
+            # Unreadable, or not what this version writes: a cache should never stop the tool, parse the file again
+            data = None
+    if data is None:
+        if source is None:
+            with open(filename, "r") as fd:
+                source = fd.read()
+        data = literal_eval(source)
+        try:
+            saved = dict(version=VERSION, sha256=digest, data=data)
+            write_atomic(compiled, lambda f: pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError as exc:
+            # Not being able to cache isn't a reason to stop
+            sys.stderr.write("Can't cache pattern: {}\n".format(exc))
+
+    parts = [part for part in data.keys() if isinstance(part, str)] if isinstance(data, dict) else []
+    index.setdefault("files", {})[filename] = dict(mtime=stat.st_mtime_ns, size=stat.st_size, sha256=digest,
+                                                   parts=parts)
+    return data
+
+
+def save_index(index, previous):
+    """Save the index, if it changed"""
+    index["version"] = VERSION
+    if index != previous:
+        try:
+            write_atomic(INDEX_FILENAME, lambda f: json.dump(index, f, indent=1, sort_keys=True), "w")
+        except OSError as exc:
+            sys.stderr.write("Can't cache pattern index: {}\n".format(exc))
+
+
+def load(filename):
+    """
+    Read a pattern-file (or its compiled form).
+    :param filename: path of the pattern-file
+    :return: object (usually a dictionary of parts)
+    """
+    index = read_index()
+    previous = json.loads(json.dumps(index))
+    data = compile_file(filename, index)
+    save_index(index, previous)
+    return data
+
+
+def parts(filename):
+    """
+    The names of the parts in a pattern-file, from the index (without reading the file, if it hasn't changed).
+    :param filename: path of the pattern-file
+    :return: list of part names
+    """
+    index = read_index()
+    entry = index.get("files", {}).get(filename)
+    if unchanged(entry, os.stat(filename)):
+        return entry["parts"]
+    previous = json.loads(json.dumps(index))
+    compile_file(filename, index)
+    save_index(index, previous)
+    return index["files"][filename]["parts"]
+
+
+@click.command()
+@click.argument("patterns", nargs=-1)
+def main(patterns):
+    """
+    Compile pattern-files (by name, default: all of them) into the cache, and show their parts.
+    """
+    index = read_index()
+    previous = json.loads(json.dumps(index))
+    for pattern in patterns or sorted(os.listdir(PATTERN_PATH)):
+        filename = os.path.join(PATTERN_PATH, pattern)
+        try:
+            compile_file(filename, index)
+        except (SyntaxError, ValueError) as exc:
+            # (e.g. the README)
+            if patterns:
+                sys.exit("{}: {}".format(pattern, exc))
+            continue
+        print("{}: {}".format(pattern, ", ".join(index["files"][filename]["parts"])))
+    save_index(index, previous)
+
+
+if __name__ == "__main__":
+    main()